@@ -0,0 +1,89 @@
+"""
+Speed vs quality of the ODE solvers of the S3Gen CFM decoder (`CFM_PARAMS["solver"]` / `ConditionalCFM.SOLVERS`)
+for different numbers of steps.
+
+The speech tokens of each text are decoded once with T3, then turned into mels with every solver / step count. The
+mels are compared with a reference integration (Euler, 32 steps) and with the default (Euler, 10 steps), as the
+relative L2 distance over the generated frames. The wavs of the reference and of every setting are written to
+`--out-dir` for listening.
+
+    python bench_cfm_solvers.py --device cpu --steps 4 6 8 10
+"""
+import argparse
+import time
+from pathlib import Path
+
+import torch
+import torchaudio as ta
+
+from chatterbox.models.s3tokenizer import drop_invalid_tokens
+from chatterbox.tts import ChatterboxTTS
+
+TEXTS = [
+    "Ezreal and Jinx teamed up with Ahri, Yasuo, and Teemo to take down the enemy's Nexus in an epic late-game pentakill.",
+    "Short lines are where the prompt dominates.",
+]
+
+
+def relative_error(ref, x):
+    return ((x - ref).norm() / ref.norm()).item()
+
+
+@torch.inference_mode()
+def mel(model, speech_tokens, solver, n_timesteps):
+    cfm = model.s3gen.flow.decoder
+    cfm.solver, cfm.n_timesteps = solver, n_timesteps
+    start = time.perf_counter()
+    mels = model.s3gen.flow_inference(speech_tokens, ref_dict=model.conds.gen, finalize=True)
+    return mels, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--voice", default=None, help="reference wav, defaults to the built-in voice")
+    parser.add_argument("--solvers", nargs="+", default=None, help="defaults to all of them")
+    parser.add_argument("--steps", type=int, nargs="+", default=[4, 6, 8, 10])
+    parser.add_argument("--reference-steps", type=int, default=32)
+    parser.add_argument("--out-dir", default="output/cfm_solvers")
+    args = parser.parse_args()
+
+    model = ChatterboxTTS.from_pretrained(args.device)
+    if args.voice:
+        model.prepare_conditionals(args.voice)
+    cfm = model.s3gen.flow.decoder
+    solvers = args.solvers or cfm.SOLVERS
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    for i, text in enumerate(TEXTS):
+        text_tokens = model._tokenize(text)
+        with torch.inference_mode():
+            torch.manual_seed(0)
+            speech_tokens = model.t3.inference(
+                t3_cond=model.conds.t3,
+                text_tokens=torch.cat([text_tokens, text_tokens]),
+                cfg_weight=0.5,
+            )[0]
+        speech_tokens = drop_invalid_tokens(speech_tokens)
+        speech_tokens = speech_tokens[speech_tokens < 6561].to(model.device)
+
+        reference, _ = mel(model, speech_tokens, "euler", args.reference_steps)
+        with torch.inference_mode():
+            wav, _ = model.s3gen.hift_inference(reference)
+        ta.save(str(out_dir / f"{i}_reference.wav"), wav.cpu(), model.sr)
+        default, default_time = mel(model, speech_tokens, "euler", 10)
+        print(f"{text!r}: {reference.size(-1)} frames, euler x10 in {default_time:.2f}s")
+        print(f"  {'solver':>8} {'steps':>5} {'time':>7} {'vs reference':>12} {'vs euler x10':>12}")
+        for solver in solvers:
+            for n_timesteps in args.steps:
+                mels, elapsed = mel(model, speech_tokens, solver, n_timesteps)
+                print(f"  {solver:>8} {n_timesteps:>5} {elapsed:>6.2f}s "
+                      f"{relative_error(reference, mels):>12.4f} {relative_error(default, mels):>12.4f}")
+                with torch.inference_mode():
+                    wav, _ = model.s3gen.hift_inference(mels)
+                ta.save(str(out_dir / f"{i}_{solver}_{n_timesteps}.wav"), wav.cpu(), model.sr)
+
+
+if __name__ == "__main__":
+    main()
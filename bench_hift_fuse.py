@@ -0,0 +1,65 @@
+"""
+Parity and speed of the fused HiFT vocoder (`S3Token2Wav.fuse_vocoder`, applied by `ChatterboxTTS.from_local`)
+against the unfused one, which recomputes the weight norms every forward.
+
+The same mels (from the built-in voice's prompt, or random ones with `--random-mels`) are vocoded by both, with the
+same seed for the sine source noise, and the waveforms are compared.
+
+    python bench_hift_fuse.py --device cpu
+"""
+import argparse
+import time
+
+import torch
+from huggingface_hub import hf_hub_download
+from safetensors.torch import load_file
+
+from chatterbox.models.s3gen import S3Gen
+from chatterbox.tts import REPO_ID, Conditionals
+
+
+@torch.inference_mode()
+def vocode(s3gen, mels, device, repeats):
+    "Waveform of `mels` and the mean time over `repeats` runs."
+    times = []
+    for _ in range(repeats):
+        torch.manual_seed(0)
+        start = time.perf_counter()
+        wav, _ = s3gen.hift_inference(mels)
+        if device.startswith("cuda"):
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return wav, sum(times[1:]) / max(len(times) - 1, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--random-mels", action="store_true")
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=4)
+    args = parser.parse_args()
+
+    state_dict = load_file(hf_hub_download(repo_id=REPO_ID, filename="s3gen.safetensors"))
+    s3gen, fused = S3Gen(), S3Gen()
+    for model in (s3gen, fused):
+        model.load_state_dict(state_dict, strict=False)
+        model.to(args.device).eval()
+    fused.fuse_vocoder()
+
+    if args.random_mels:
+        mels = torch.randn(1, 80, args.frames, device=args.device) - 6
+    else:
+        conds = Conditionals.load(hf_hub_download(repo_id=REPO_ID, filename="conds.pt")).to(args.device)
+        mels = conds.gen["prompt_feat"].transpose(1, 2)[..., :args.frames]
+
+    ref, ref_time = vocode(s3gen, mels, args.device, args.repeats)
+    wav, fused_time = vocode(fused, mels, args.device, args.repeats)
+    print(f"{mels.size(-1)} frames, {wav.size(-1)} samples")
+    print(f"unfused {ref_time * 1000:.1f}ms  fused {fused_time * 1000:.1f}ms")
+    print(f"max abs diff {(wav - ref).abs().max().item():.2e}  "
+          f"relative L2 {((wav - ref).norm() / ref.norm()).item():.2e}")
+
+
+if __name__ == "__main__":
+    main()
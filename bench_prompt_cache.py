@@ -0,0 +1,82 @@
+"""
+Time of the S3Gen flow on short utterances with and without the per-voice prompt cache
+(`S3Token2Mel.cache_prompt`, see `CausalMaskedDiffWithXvec.embed_prompt`), and where the time goes.
+
+The encoder and the CFM decoder attend over the prompt and the new tokens together, so only the position-wise
+prompt-side work (token embedding, encoder input layer, speaker projection) is cached. The breakdown shows how much of
+the flow is spent in the encoder vs the decoder for each length, ie. how much of it a ~10 s prompt accounts for.
+
+    python bench_prompt_cache.py --device cpu --voice voices/alice.wav
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.tts import ChatterboxTTS
+
+# Number of speech tokens of the utterances (25 tokens/s)
+LENGTHS = [25, 50, 100, 200]
+
+
+def timed(fn, device, repeats):
+    "Mean time of `fn()` over `repeats` runs, after a warmup run."
+    fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return out, (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--voice", default=None, help="reference wav, defaults to the built-in voice")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    model = ChatterboxTTS.from_pretrained(args.device)
+    if args.voice:
+        model.prepare_conditionals(args.voice)
+    s3gen, ref_dict = model.s3gen, model.conds.gen
+    flow = s3gen.flow
+    n_prompt = ref_dict["prompt_token"].size(1)
+    print(f"prompt: {n_prompt} tokens ({n_prompt / flow.input_frame_rate:.1f}s)")
+
+    # Time spent in the encoder, the rest of the flow is the CFM decoder
+    encoder_time = [0.0]
+    encoder_forward = flow.encoder.forward
+
+    def encoder_timed(*a, **kw):
+        start = time.perf_counter()
+        out = encoder_forward(*a, **kw)
+        encoder_time[0] += time.perf_counter() - start
+        return out
+
+    flow.encoder.forward = encoder_timed
+
+    print(f"{'tokens':>6} {'no cache':>9} {'cache':>9} {'encoder':>8} {'max diff':>9}")
+    for n_tokens in LENGTHS:
+        speech_tokens = torch.randint(0, 6561, (n_tokens,), device=args.device)
+
+        def flow_inference(cache):
+            s3gen.cache_prompt = cache
+            ref = ref_dict if cache else {k: v for k, v in ref_dict.items() if k != "prompt_cache"}
+            with torch.inference_mode():
+                return s3gen.flow_inference(speech_tokens, ref_dict=ref, finalize=True)
+
+        torch.manual_seed(0)
+        ref_mels, ref_time = timed(lambda: flow_inference(False), args.device, args.repeats)
+        encoder_time[0] = 0.0
+        mels, cache_time = timed(lambda: flow_inference(True), args.device, args.repeats)
+        encoder_share = encoder_time[0] / (args.repeats + 1) / cache_time
+        print(f"{n_tokens:>6} {ref_time:>8.3f}s {cache_time:>8.3f}s {encoder_share:>7.1%} "
+              f"{(mels - ref_mels).abs().max().item():>9.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Speed and output drift of the int8 dynamically quantized model (`ChatterboxTTS.from_pretrained(quantize=True)`)
+against the float one, on CPU.
+
+For every text, the float model's speech tokens are used for both models so that the stages can be compared:
+- T3: decode time, and top-1 agreement of the next token logits on the float model's tokens (teacher forcing)
+- S3Gen: time and relative L2 drift of the mel from the flow, and of the waveform
+
+    python bench_quantize.py --voice voices/alice.wav
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.models.s3tokenizer import drop_invalid_tokens
+from chatterbox.tts import ChatterboxTTS
+
+TEXTS = [
+    "Ezreal and Jinx teamed up with Ahri, Yasuo, and Teemo to take down the enemy's Nexus in an epic late-game pentakill.",
+    "The quick brown fox jumps over the lazy dog, then naps in the warm afternoon sun.",
+]
+
+
+def relative_drift(ref, x):
+    n = min(ref.size(-1), x.size(-1))
+    ref, x = ref[..., :n], x[..., :n]
+    return ((ref - x).norm() / ref.norm()).item()
+
+
+@torch.inference_mode()
+def next_token_argmax(t3, conds, text_tokens, speech_tokens, cfg_weight):
+    bos = torch.full((1, 1), t3.hp.start_speech_token, dtype=torch.long)
+    speech_tokens = torch.cat([bos, speech_tokens.view(1, -1)], dim=1)
+    if cfg_weight > 0:
+        speech_tokens = torch.cat([speech_tokens, speech_tokens])
+    embeds, _ = t3.prepare_input_embeds(
+        t3_cond=conds.t3,
+        text_tokens=text_tokens,
+        speech_tokens=speech_tokens,
+        cfg_weight=cfg_weight,
+    )
+    logits = t3.get_backend()(inputs_embeds=embeds, use_cache=False).logits[:, -speech_tokens.size(1):]
+    if cfg_weight > 0:
+        logits = logits[:1] + cfg_weight * (logits[:1] - logits[1:])
+    return logits[0].argmax(-1)
+
+
+@torch.inference_mode()
+def run(model, text, cfg_weight, speech_tokens=None):
+    "Returns the speech tokens, T3 / S3Gen times, next token argmax and the mel / wav of `model`."
+    text_tokens = model._tokenize(text)
+    if cfg_weight > 0:
+        text_tokens = torch.cat([text_tokens, text_tokens])
+
+    torch.manual_seed(0)
+    start = time.perf_counter()
+    tokens = model.t3.inference(t3_cond=model.conds.t3, text_tokens=text_tokens, cfg_weight=cfg_weight)[0]
+    t3_time = time.perf_counter() - start
+    if speech_tokens is None:
+        speech_tokens = tokens
+    argmax = next_token_argmax(model.t3, model.conds, text_tokens, speech_tokens, cfg_weight)
+
+    s3_tokens = drop_invalid_tokens(speech_tokens)
+    s3_tokens = s3_tokens[s3_tokens < 6561]
+    start = time.perf_counter()
+    mel = model.s3gen.flow_inference(s3_tokens, ref_dict=model.conds.gen, finalize=True)
+    wav, _ = model.s3gen.hift_inference(mel)
+    s3gen_time = time.perf_counter() - start
+    return speech_tokens, t3_time, s3gen_time, argmax, mel, wav
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--voice", default=None, help="reference wav, defaults to the built-in voice")
+    parser.add_argument("--cfg-weight", type=float, default=0.5)
+    args = parser.parse_args()
+
+    models = {
+        "float": ChatterboxTTS.from_pretrained("cpu"),
+        "int8": ChatterboxTTS.from_pretrained("cpu", quantize=True),
+    }
+    if args.voice:
+        for model in models.values():
+            model.prepare_conditionals(args.voice)
+
+    for text in TEXTS:
+        speech_tokens, *ref = run(models["float"], text, args.cfg_weight)
+        _, *quant = run(models["int8"], text, args.cfg_weight, speech_tokens=speech_tokens)
+        print(text)
+        print(f"  T3     float {ref[0]:6.2f}s  int8 {quant[0]:6.2f}s  "
+              f"top-1 agreement {(ref[2] == quant[2]).float().mean().item():.3f}")
+        print(f"  S3Gen  float {ref[1]:6.2f}s  int8 {quant[1]:6.2f}s  "
+              f"mel drift {relative_drift(ref[3], quant[3]):.4f}  wav drift {relative_drift(ref[4], quant[4]):.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Speed vs quality of T3 decoding with fewer Llama layers, see `T3.get_backend(num_layers=...)`.
+
+For every depth, reports:
+- tokens/s of `T3.inference` on the same text
+- top-1 agreement with the full model: the full model's tokens are fed to the reduced model (teacher forcing), and we
+  count how often both models rank the same token first. Sampled tokens aren't comparable run to run, this is.
+
+    python bench_t3_depth.py --device cpu --depths 30 24 20 16 --voice voices/alice.wav
+"""
+import argparse
+import time
+
+import torch
+
+from chatterbox.tts import ChatterboxTTS
+
+TEXTS = [
+    "Ezreal and Jinx teamed up with Ahri, Yasuo, and Teemo to take down the enemy's Nexus in an epic late-game pentakill.",
+    "The quick brown fox jumps over the lazy dog, then naps in the warm afternoon sun.",
+]
+
+
+@torch.inference_mode()
+def top1_agreement(t3, conds, text_tokens, speech_tokens, num_layers, cfg_weight):
+    "Fraction of positions where the full model and the reduced one agree on the most likely next token."
+    bos = torch.full((1, 1), t3.hp.start_speech_token, dtype=torch.long, device=t3.device)
+    speech_tokens = torch.cat([bos, speech_tokens.view(1, -1)], dim=1)
+    if cfg_weight > 0:
+        speech_tokens = torch.cat([speech_tokens, speech_tokens])
+    embeds, _ = t3.prepare_input_embeds(
+        t3_cond=conds.t3,
+        text_tokens=text_tokens,
+        speech_tokens=speech_tokens,
+        cfg_weight=cfg_weight,
+    )
+    n = speech_tokens.size(1)
+
+    def guided_argmax(backend):
+        logits = backend(inputs_embeds=embeds, use_cache=False).logits[:, -n:]
+        if cfg_weight > 0:
+            logits = logits[:1] + cfg_weight * (logits[:1] - logits[1:])
+        return logits[0].argmax(-1)
+
+    full = guided_argmax(t3.get_backend())
+    reduced = guided_argmax(t3.get_backend(num_layers))
+    return (full == reduced).float().mean().item()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--voice", default=None, help="reference wav, defaults to the built-in voice")
+    parser.add_argument("--depths", type=int, nargs="+", default=[30, 26, 22, 18, 14])
+    parser.add_argument("--cfg-weight", type=float, default=0.5)
+    parser.add_argument("--max-new-tokens", type=int, default=300)
+    args = parser.parse_args()
+
+    model = ChatterboxTTS.from_pretrained(args.device)
+    if args.voice:
+        model.prepare_conditionals(args.voice)
+    conds, t3 = model.conds, model.t3
+
+    # Reference tokens from the full model
+    refs = []
+    for text in TEXTS:
+        text_tokens = model._tokenize(text)
+        if args.cfg_weight > 0:
+            text_tokens = torch.cat([text_tokens, text_tokens])
+        torch.manual_seed(0)
+        speech_tokens = t3.inference(
+            t3_cond=conds.t3,
+            text_tokens=text_tokens,
+            max_new_tokens=args.max_new_tokens,
+            cfg_weight=args.cfg_weight,
+        )[0]
+        refs.append((text_tokens, speech_tokens))
+
+    print(f"{'layers':>6} {'tokens/s':>9} {'top-1 agreement':>16}")
+    for depth in args.depths:
+        n_tokens, elapsed, agreement = 0, 0.0, []
+        for text_tokens, ref_tokens in refs:
+            torch.manual_seed(0)
+            start = time.perf_counter()
+            speech_tokens = t3.inference(
+                t3_cond=conds.t3,
+                text_tokens=text_tokens,
+                max_new_tokens=args.max_new_tokens,
+                cfg_weight=args.cfg_weight,
+                num_layers=depth,
+            )
+            elapsed += time.perf_counter() - start
+            n_tokens += speech_tokens.size(1)
+            agreement.append(top1_agreement(t3, conds, text_tokens, ref_tokens, depth, args.cfg_weight))
+        print(f"{depth:>6} {n_tokens / elapsed:>9.1f} {sum(agreement) / len(agreement):>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
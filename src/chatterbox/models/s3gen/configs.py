@@ -2,7 +2,8 @@ from ..utils import AttrDict
 
 CFM_PARAMS = AttrDict({
     "sigma_min": 1e-06,
-    "solver": "euler",
+    "solver": "euler",  # one of ConditionalCFM.SOLVERS
+    "n_timesteps": 10,
     "t_scheduler": "cosine",
     "training_cfg_rate": 0.2,
     "inference_cfg_rate": 0.7,
@@ -230,7 +230,23 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None):
+    def embed_time(self, t):
+        "(batch_size,) times to the (batch_size, time_embed_dim) embeddings used by the blocks."
+        t = self.time_embeddings(t).to(t.dtype)
+        return self.time_mlp(t)
+
+    def attention_bias(self, x, mask, attn_biases: dict):
+        """
+        The attention bias of the transformer blocks for `mask`, memoized in `attn_biases` by sequence length: all the
+        blocks at the same resolution share it, and so do all the steps of an ODE solve if the caller keeps the dict.
+        """
+        length = mask.size(-1)
+        if length not in attn_biases:
+            attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, self.static_chunk_size, -1)
+            attn_biases[length] = mask_to_bias(attn_mask == 1, x.dtype)
+        return attn_biases[length]
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, t_emb=None, attn_biases=None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -239,6 +255,9 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            t_emb (torch.Tensor, optional): precomputed `embed_time(t)`. Defaults to None.
+            attn_biases (dict, optional): attention biases by sequence length, see `attention_bias`. Pass the same
+                dict to calls with the same `mask` to reuse them. Defaults to None.
 
         Raises:
             ValueError: _description_
@@ -248,8 +267,9 @@ class ConditionalDecoder(nn.Module):
             _type_: _description_
         """
 
-        t = self.time_embeddings(t).to(t.dtype)
-        t = self.time_mlp(t)
+        t = self.embed_time(t) if t_emb is None else t_emb
+        if attn_biases is None:
+            attn_biases = {}
 
         x = pack([x, mu], "b * t")[0]
 
@@ -266,8 +286,7 @@ class ConditionalDecoder(nn.Module):
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
             # attn_mask = torch.matmul(mask_down.transpose(1, 2).contiguous(), mask_down)
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
+            attn_mask = self.attention_bias(x, mask_down, attn_biases)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -285,8 +304,7 @@ class ConditionalDecoder(nn.Module):
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
             # attn_mask = torch.matmul(mask_mid.transpose(1, 2).contiguous(), mask_mid)
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
+            attn_mask = self.attention_bias(x, mask_mid, attn_biases)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -302,8 +320,7 @@ class ConditionalDecoder(nn.Module):
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
             # attn_mask = torch.matmul(mask_up.transpose(1, 2).contiguous(), mask_up)
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            attn_mask = mask_to_bias(attn_mask == 1, x.dtype)
+            attn_mask = self.attention_bias(x, mask_up, attn_biases)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
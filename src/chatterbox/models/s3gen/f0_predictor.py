@@ -13,6 +13,7 @@
 # limitations under the License.
 import torch
 import torch.nn as nn
+from torch.nn.utils import parametrize
 from torch.nn.utils.parametrizations import weight_norm
 
 
@@ -49,6 +50,11 @@ class ConvRNNF0Predictor(nn.Module):
         )
         self.classifier = nn.Linear(in_features=cond_channels, out_features=self.num_class)
 
+    def remove_weight_norm(self):
+        for m in self.condnet:
+            if parametrize.is_parametrized(m, "weight"):
+                parametrize.remove_parametrizations(m, "weight")
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.condnet(x)
         x = x.transpose(1, 2)
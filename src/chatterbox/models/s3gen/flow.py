@@ -131,24 +131,24 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   flow_cache):
-        if self.fp16 is True:
-            prompt_feat = prompt_feat.half()
-            embedding = embedding.half()
+        # The encoder and decoder estimator can run in a lower precision (see `S3Token2Wav.set_dtype`), the
+        # conditions and the ODE state stay in float32
+        dtype = self.input_embedding.weight.dtype
 
         assert token.shape[0] == 1
         # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+        embedding = F.normalize(embedding.to(dtype), dim=1)
+        embedding = self.spk_embed_affine_layer(embedding).float()
 
         # concat text and prompt_text
         token_len1, token_len2 = prompt_token.shape[1], token.shape[1]
         token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
-        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(dtype)
         token = self.input_embedding(torch.clamp(token, min=0)) * mask
 
         # text encode
         h, h_lengths = self.encoder(token, token_len)
-        h = self.encoder_proj(h)
+        h = self.encoder_proj(h).float()
         mel_len1, mel_len2 = prompt_feat.shape[1], int(token_len2 / self.input_frame_rate * 22050 / 256)
         h, h_lengths = self.length_regulator.inference(h[:, :token_len1], h[:, token_len1:], mel_len1, mel_len2, self.input_frame_rate)
 
@@ -163,7 +163,6 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
             prompt_len=mel_len1,
             flow_cache=flow_cache
         )
@@ -230,9 +229,6 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         self.token_mel_ratio = token_mel_ratio
         self.pre_lookahead_len = pre_lookahead_len
 
-        # FIXME: this was missing - just putting it in as false
-        self.fp16 = False
-
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -242,27 +238,43 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  finalize):
-        if self.fp16 is True:
-            prompt_feat = prompt_feat.half()
-            embedding = embedding.half()
+                  finalize,
+                  prompt_cache: Optional[dict] = None):
+        """
+        `prompt_cache`: a dict kept with the voice (eg. in its `ref_dict`), filled on first use with the prompt-side
+        work that doesn't depend on the new tokens, see `embed_prompt`.
+        """
+        # The encoder and decoder estimator can run in a lower precision (see `S3Token2Wav.set_dtype`), the
+        # conditions and the ODE state stay in float32
+        dtype = self.input_embedding.weight.dtype
 
         assert token.shape[0] == 1
-        # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+        if prompt_cache is not None:
+            cached = prompt_cache.get("prompt_xs")
+            if cached is None or cached.dtype != dtype or cached.device != token.device:
+                prompt_cache.update(self.embed_prompt(prompt_token, prompt_token_len, embedding))
+            embedding = prompt_cache["spks"]
 
-        # concat text and prompt_text
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
-        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
-        token = self.input_embedding(torch.clamp(token, min=0)) * mask
+            # text encode, the prompt tokens only go through the encoder layers
+            token_len = prompt_token_len + token_len
+            token = self.input_embedding(torch.clamp(token, min=0))
+            h, h_lengths = self.encoder(token, token_len, prompt_xs=prompt_cache["prompt_xs"])
+        else:
+            # xvec projection
+            embedding = F.normalize(embedding.to(dtype), dim=1)
+            embedding = self.spk_embed_affine_layer(embedding).float()
 
-        # text encode
-        h, h_lengths = self.encoder(token, token_len)
+            # concat text and prompt_text
+            token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+            mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(dtype)
+            token = self.input_embedding(torch.clamp(token, min=0)) * mask
+
+            # text encode
+            h, h_lengths = self.encoder(token, token_len)
         if finalize is False:
             h = h[:, :-self.pre_lookahead_len * self.token_mel_ratio]
         mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
-        h = self.encoder_proj(h)
+        h = self.encoder_proj(h).float()
 
         # get conditions
         conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
@@ -275,8 +287,23 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), None  # NOTE jrm: why are they returning None here?
+
+    @torch.inference_mode()
+    def embed_prompt(self, prompt_token, prompt_token_len, embedding):
+        """
+        The per-voice part of `inference`: the projected speaker embedding, and the prompt tokens through the token
+        embedding and the (position-wise) input layer of the encoder. The encoder layers and the decoder attend over
+        the prompt and the new tokens together, so their prompt-side work can't be reused.
+        """
+        dtype = self.input_embedding.weight.dtype
+        spks = F.normalize(embedding.to(dtype), dim=1)
+        spks = self.spk_embed_affine_layer(spks).float()
+
+        mask = (~make_pad_mask(prompt_token_len, prompt_token.size(1))).unsqueeze(-1).to(dtype)
+        prompt_xs = self.input_embedding(torch.clamp(prompt_token, min=0)) * mask
+        prompt_xs = self.encoder.embed_prompt(prompt_xs)
+        return dict(spks=spks, prompt_xs=prompt_xs)
@@ -19,6 +19,10 @@ from .configs import CFM_PARAMS
 
 
 class ConditionalCFM(BASECFM):
+    # Solvers and their number of estimator calls per step: Euler and the 2nd order Adams-Bashforth multistep
+    # method (which reuses the previous step's velocity) cost one, midpoint and Heun two.
+    SOLVERS = ("euler", "midpoint", "heun", "ab2")
+
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
         super().__init__(
             n_feats=in_channels,
@@ -29,13 +33,16 @@ class ConditionalCFM(BASECFM):
         self.t_scheduler = cfm_params.t_scheduler
         self.training_cfg_rate = cfm_params.training_cfg_rate
         self.inference_cfg_rate = cfm_params.inference_cfg_rate
+        # ODE solver and default number of steps at inference, see `solve`
+        assert self.solver in self.SOLVERS, f"unknown solver {self.solver!r}, expected one of {self.SOLVERS}"
+        self.n_timesteps = cfm_params.get("n_timesteps", 10)
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
         self.lock = threading.Lock()
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps=None, temperature=1.0, spks=None, cond=None, prompt_len=0, flow_cache=torch.zeros(1, 80, 0, 2)):
         """Forward diffusion
 
         Args:
@@ -43,7 +50,7 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, n_feats, mel_timesteps)
             mask (torch.Tensor): output_mask
                 shape: (batch_size, 1, mel_timesteps)
-            n_timesteps (int): number of diffusion steps
+            n_timesteps (int, optional): number of diffusion steps. Defaults to `self.n_timesteps`.
             temperature (float, optional): temperature for scaling noise. Defaults to 1.0.
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
@@ -64,12 +71,65 @@ class ConditionalCFM(BASECFM):
         mu_cache = torch.concat([mu[:, :, :prompt_len], mu[:, :, -34:]], dim=2)
         flow_cache = torch.stack([z_cache, mu_cache], dim=-1)
 
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
+        t_span = torch.linspace(0, 1, (n_timesteps or self.n_timesteps) + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), flow_cache
+
+    def solve(self, x, t_span, mu, mask, spks, cond):
+        "Integrate the ODE with `self.solver`, see `solve_euler` for the arguments."
+        return getattr(self, f"solve_{self.solver}")(x, t_span, mu, mask, spks, cond)
+
+    def cfg_velocity(self, mu, mask, spks, cond, t_span=None):
+        """
+        The velocity field of the ODE, as a function of `(x, t)`, with classifier-free guidance (as in VoiceBox):
+        the estimator runs on a batch of the conditional and unconditional inputs, and the two are mixed with
+        `inference_cfg_rate`.
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond):
+        Only `x` and `t` change between calls: the other inputs are written into the estimator batch once, the
+        time embeddings of `t_span` are computed in a single batch up front (other times are embedded on demand),
+        and the attention biases of the estimator are computed on the first call and reused.
+        """
+        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
+        x_in = torch.zeros([2, 80, mu.size(2)], device=mu.device, dtype=mu.dtype)
+        mask_in = torch.zeros([2, 1, mu.size(2)], device=mu.device, dtype=mu.dtype)
+        mu_in = torch.zeros([2, 80, mu.size(2)], device=mu.device, dtype=mu.dtype)
+        t_in = torch.zeros([2], device=mu.device, dtype=mu.dtype)
+        spks_in = torch.zeros([2, 80], device=mu.device, dtype=mu.dtype)
+        cond_in = torch.zeros([2, 80, mu.size(2)], device=mu.device, dtype=mu.dtype)
+        mask_in[:] = mask
+        mu_in[0] = mu
+        spks_in[0] = spks
+        cond_in[0] = cond
+
+        t_embs, attn_biases = {}, {}
+        if isinstance(self.estimator, torch.nn.Module) and t_span is not None:
+            t_embs = dict(zip(t_span.tolist(), self.embed_time(t_span)))
+
+        def velocity(x, t):
+            t = float(t)
+            x_in[:] = x
+            t_in[:] = t
+            t_emb = None
+            if isinstance(self.estimator, torch.nn.Module):
+                if t not in t_embs:
+                    t_embs[t] = self.embed_time(t_in[:1])[0]
+                t_emb = t_embs[t].expand(2, -1)
+            dphi_dt = self.forward_estimator(
+                x_in, mask_in, mu_in, t_in, spks_in, cond_in, t_emb=t_emb, attn_biases=attn_biases,
+            )
+            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
+            # (1 + cfg_rate) * dphi_dt - cfg_rate * cfg_dphi_dt
+            return torch.lerp(cfg_dphi_dt, dphi_dt, 1.0 + self.inference_cfg_rate)
+
+        return velocity
+
+    def embed_time(self, t):
+        "The estimator's time embeddings of the (N,) times `t`, in the estimator's dtype."
+        dtype = next(self.estimator.parameters()).dtype
+        return self.estimator.embed_time(t.to(dtype))
+
+    def solve_euler(self, x, t_span, mu, mask, spks, cond, return_all_steps=False):
         """
         Fixed euler solver for ODEs.
         Args:
@@ -83,48 +143,68 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            return_all_steps: also return the list of `x` after every step, eg. to plot the trajectory
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
-
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
+        velocity = self.cfg_velocity(mu, mask, spks, cond, t_span=t_span)
         sol = []
+        ts = t_span.tolist()
+        x = x.clone()  # updated in place
+        for t, t_next in zip(ts[:-1], ts[1:]):
+            x.add_(velocity(x, t), alpha=t_next - t)
+            if return_all_steps:
+                sol.append(x.to(torch.float32, copy=True))
 
-        # Do not use concat, it may cause memory format changed and trt infer with wrong results!
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=x.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=x.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=x.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=x.dtype)
-        for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
+        if return_all_steps:
+            return x.float(), sol
+        return x.float()
+
+    def solve_midpoint(self, x, t_span, mu, mask, spks, cond):
+        "Explicit midpoint method, 2nd order, see `solve_euler` for the arguments."
+        velocity = self.cfg_velocity(mu, mask, spks, cond, t_span=t_span)
+        for t, t_next in zip(t_span[:-1], t_span[1:]):
+            dt = t_next - t
+            x_mid = x + 0.5 * dt * velocity(x, t)
+            x = x + dt * velocity(x_mid, t + 0.5 * dt)
+        return x.float()
 
-        return sol[-1].float()
+    def solve_heun(self, x, t_span, mu, mask, spks, cond):
+        "Heun's method (explicit trapezoidal), 2nd order, see `solve_euler` for the arguments."
+        velocity = self.cfg_velocity(mu, mask, spks, cond, t_span=t_span)
+        for t, t_next in zip(t_span[:-1], t_span[1:]):
+            dt = t_next - t
+            k1 = velocity(x, t)
+            k2 = velocity(x + dt * k1, t_next)
+            x = x + 0.5 * dt * (k1 + k2)
+        return x.float()
+
+    def solve_ab2(self, x, t_span, mu, mask, spks, cond):
+        """
+        2nd order Adams-Bashforth for variable steps: a multistep method extrapolating from the velocities of the
+        current and previous steps, so it costs a single estimator call per step like Euler. The first step is Euler.
+        See `solve_euler` for the arguments.
+        """
+        velocity = self.cfg_velocity(mu, mask, spks, cond, t_span=t_span)
+        prev = None  # (velocity, dt) of the previous step
+        for t, t_next in zip(t_span[:-1], t_span[1:]):
+            dt = t_next - t
+            k = velocity(x, t)
+            if prev is None:
+                x = x + dt * k
+            else:
+                k_prev, dt_prev = prev
+                r = dt / (2 * dt_prev)
+                x = x + dt * ((1 + r) * k - r * k_prev)
+            prev = (k, dt)
+        return x.float()
 
-    def forward_estimator(self, x, mask, mu, t, spks, cond):
+    def forward_estimator(self, x, mask, mu, t, spks, cond, t_emb=None, attn_biases=None):
         if isinstance(self.estimator, torch.nn.Module):
-            return self.estimator.forward(x, mask, mu, t, spks, cond)
+            dtype = next(self.estimator.parameters()).dtype
+            if dtype != x.dtype:
+                # eg. a bfloat16 estimator, the solver state stays in float32
+                inputs = (v.to(dtype) for v in (x, mask, mu, t, spks, cond))
+                return self.estimator.forward(*inputs, t_emb=t_emb, attn_biases=attn_biases).to(x.dtype)
+            return self.estimator.forward(x, mask, mu, t, spks, cond, t_emb=t_emb, attn_biases=attn_biases)
         else:
             with self.lock:
                 self.estimator.set_input_shape('x', (2, 80, x.size(2)))
@@ -191,7 +271,7 @@ class CausalConditionalCFM(ConditionalCFM):
         self.rand_noise = torch.randn([1, 80, 50 * 300])
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None):
+    def forward(self, mu, mask, n_timesteps=None, temperature=1.0, spks=None, cond=None):
         """Forward diffusion
 
         Args:
@@ -199,7 +279,7 @@ class CausalConditionalCFM(ConditionalCFM):
                 shape: (batch_size, n_feats, mel_timesteps)
             mask (torch.Tensor): output_mask
                 shape: (batch_size, 1, mel_timesteps)
-            n_timesteps (int): number of diffusion steps
+            n_timesteps (int, optional): number of diffusion steps. Defaults to `self.n_timesteps`.
             temperature (float, optional): temperature for scaling noise. Defaults to 1.0.
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
@@ -212,7 +292,7 @@ class CausalConditionalCFM(ConditionalCFM):
 
         z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
         # fix prompt and overlap part mu and z
-        t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
+        t_span = torch.linspace(0, 1, (n_timesteps or self.n_timesteps) + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), None
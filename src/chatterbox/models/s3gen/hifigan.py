@@ -24,7 +24,7 @@ import torch
 import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
-from torch.nn.utils import remove_weight_norm
+from torch.nn.utils import parametrize
 from torch.nn.utils.parametrizations import weight_norm
 from torch.distributions.uniform import Uniform
 from torch import nn, sin, pow
@@ -70,12 +70,30 @@ class Snake(nn.Module):
 
         self.no_div_by_zero = 0.000000001
 
+        # alpha and 1 / alpha lined up with x, set by `fuse`
+        self.register_buffer("fused_alpha", None, persistent=False)
+        self.register_buffer("fused_inv_alpha", None, persistent=False)
+
+    def fuse(self):
+        """
+        Inference only: precompute alpha and 1 / alpha, the forward then computes
+        x + 1/a * sin^2 (xa) without the intermediate [B, C, T] tensors.
+        """
+        alpha = self.alpha.detach().view(1, -1, 1)
+        if self.alpha_logscale:
+            alpha = torch.exp(alpha)
+        self.fused_alpha = alpha
+        self.fused_inv_alpha = 1.0 / (alpha + self.no_div_by_zero)
+
     def forward(self, x):
         '''
         Forward pass of the function.
         Applies the function to the input elementwise.
         Snake ∶= x + 1/a * sin^2 (xa)
         '''
+        if self.fused_alpha is not None:
+            return torch.addcmul(x, self.fused_inv_alpha, torch.sin(x * self.fused_alpha).square_())
+
         alpha = self.alpha.unsqueeze(0).unsqueeze(-1) # line up with x to [B, C, T]
         if self.alpha_logscale:
             alpha = torch.exp(alpha)
@@ -85,6 +103,14 @@ class Snake(nn.Module):
 
 
 
+def remove_weight_norm(module):
+    "Fold the weight norm of `module` into its weight, for both `parametrizations.weight_norm` and the older hooks."
+    if parametrize.is_parametrized(module, "weight"):
+        parametrize.remove_parametrizations(module, "weight")
+    else:
+        torch.nn.utils.remove_weight_norm(module)
+
+
 def get_padding(kernel_size, dilation=1):
     return int((kernel_size * dilation - dilation) / 2)
 
@@ -198,9 +224,11 @@ class SineGen(torch.nn.Module):
         return uv
 
     @torch.no_grad()
-    def forward(self, f0):
+    def forward(self, f0, state: Optional[dict] = None):
         """
         :param f0: [B, 1, sample_len], Hz
+        :param state: for streaming, a dict (initially empty) passed along
+            with consecutive chunks of `f0`, which keeps the phase continuous
         :return: [B, 1, sample_len]
         """
 
@@ -208,10 +236,18 @@ class SineGen(torch.nn.Module):
         for i in range(self.harmonic_num + 1):
             F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
 
-        theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
-        phase_vec[:, 0, :] = 0
+        cycles = torch.cumsum(F_mat, dim=-1)
+        if state is not None and "cycles" in state:
+            cycles = cycles + state["cycles"]
+            phase_vec = state["phase_vec"]
+        else:
+            u_dist = Uniform(low=-np.pi, high=np.pi)
+            phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+            phase_vec[:, 0, :] = 0
+        theta_mat = 2 * np.pi * (cycles % 1)
+        if state is not None and f0.size(-1) > 0:
+            state["cycles"] = cycles[:, :, -1:] % 1
+            state["phase_vec"] = phase_vec
 
         # generate sine waveforms
         sine_waves = self.sine_amp * torch.sin(theta_mat + phase_vec)
@@ -264,16 +300,17 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_linear = torch.nn.Linear(harmonic_num + 1, 1)
         self.l_tanh = torch.nn.Tanh()
 
-    def forward(self, x):
+    def forward(self, x, state: Optional[dict] = None):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
         Sine_source (batchsize, length, 1)
         noise_source (batchsize, length 1)
+        state: streaming state of the sine generator, see `SineGen.forward`
         """
         # source for harmonic branch
         with torch.no_grad():
-            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2))
+            sine_wavs, uv, _ = self.l_sin_gen(x.transpose(1, 2), state)
             sine_wavs = sine_wavs.transpose(1, 2)
             uv = uv.transpose(1, 2)
         sine_merge = self.l_tanh(self.l_linear(sine_wavs))
@@ -376,27 +413,35 @@ class HiFTGenerator(nn.Module):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
-        self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        self.register_buffer("stft_window", stft_window, persistent=False)
         self.f0_predictor = f0_predictor
 
     def remove_weight_norm(self):
-        print('Removing weight norm...')
         for l in self.ups:
             remove_weight_norm(l)
         for l in self.resblocks:
             l.remove_weight_norm()
         remove_weight_norm(self.conv_pre)
         remove_weight_norm(self.conv_post)
-        self.m_source.remove_weight_norm()
-        for l in self.source_downs:
-            remove_weight_norm(l)
         for l in self.source_resblocks:
             l.remove_weight_norm()
+        self.f0_predictor.remove_weight_norm()
+
+    def fuse(self):
+        """
+        Inference only: fold the weight norms into the conv weights, which are otherwise recomputed every forward,
+        and precompute the Snake coefficients. Call it after loading the weights.
+        """
+        self.remove_weight_norm()
+        for m in self.modules():
+            if isinstance(m, Snake):
+                m.fuse()
 
     def _stft(self, x):
         spec = torch.stft(
             x,
-            self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window.to(x.device),
+            self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window,
             return_complex=True)
         spec = torch.view_as_real(spec)  # [B, F, TT, 2]
         return spec[..., 0], spec[..., 1]
@@ -406,13 +451,16 @@ class HiFTGenerator(nn.Module):
         real = magnitude * torch.cos(phase)
         img = magnitude * torch.sin(phase)
         inverse_transform = torch.istft(torch.complex(real, img), self.istft_params["n_fft"], self.istft_params["hop_len"],
-                                        self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
+                                        self.istft_params["n_fft"], window=self.stft_window)
         return inverse_transform
 
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
 
+        # The convolution stack can run in a lower precision, the STFT / iSTFT stay in float32
+        dtype = self.conv_post.bias.dtype
+        x, s_stft = x.to(dtype), s_stft.to(dtype)
         x = self.conv_pre(x)
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, self.lrelu_slope)
@@ -435,7 +483,7 @@ class HiFTGenerator(nn.Module):
             x = xs / self.num_kernels
 
         x = F.leaky_relu(x)
-        x = self.conv_post(x)
+        x = self.conv_post(x).float()
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
 
@@ -472,3 +520,70 @@ class HiFTGenerator(nn.Module):
             s[:, :, :cache_source.shape[2]] = cache_source
         generated_speech = self.decode(x=speech_feat, s=s)
         return generated_speech, s
+
+
+class HiFTStreamer:
+    """
+    Vocodes a mel-spectrogram chunk by chunk with a `HiFTGenerator`, with bounded memory. Up to the random noise of
+    the sine source, the concatenated output is the waveform `HiFTGenerator.inference` would give for the whole mel.
+
+    - The F0 predictor and the decoder are not causal: a frame is vocoded once `f0_context` + `decode_context`
+      later frames have arrived (or when finalizing), and each call re-runs them over that many frames of context
+      on both sides, kept from the previous chunks.
+    - The sine source is generated once per frame and kept for the context, its phase carries over between chunks.
+    - The iSTFT overlap-add of a window is only kept away from its edges, where it has all its frames.
+    """
+
+    # Receptive field, in mel frames, of the F0 predictor (5 convolutions of size 3) and of `HiFTGenerator.decode`
+    # (about 14.2 frames on either side, rounded up)
+    f0_context = 5
+    decode_context = 16
+
+    def __init__(self, hift: HiFTGenerator):
+        self.hift = hift
+        self.hop_len = int(hift.f0_upsamp.scale_factor)  # samples per mel frame
+        self.mel = None  # [1, 80, T] mel frames still needed
+        self.source = None  # [1, 1, n_source * hop_len] source of the first `n_source` frames of `self.mel`
+        self.n_source = 0
+        self.n_out = 0  # frames of `self.mel` already vocoded
+        self.n_samples = 0  # samples returned so far
+        self.sine_state = {}
+
+    @torch.inference_mode()
+    def push(self, mel: torch.Tensor, finalize: bool = False) -> torch.Tensor:
+        """
+        Add the next [1, 80, T] mel frames, and return the [1, num_samples] waveform that can be computed so far,
+        or all the rest if `finalize`.
+        """
+        hift, hop_len = self.hift, self.hop_len
+        self.mel = mel if self.mel is None else torch.cat([self.mel, mel], dim=2)
+        n_mel = self.mel.size(2)
+
+        # mel->f0->source, for the frames with all their F0 context
+        end = n_mel if finalize else n_mel - self.f0_context
+        if end > self.n_source:
+            start = max(self.n_source - self.f0_context, 0)
+            f0 = hift.f0_predictor(self.mel[:, :, start:])[:, self.n_source - start:end - start]
+            s = hift.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
+            s, _, _ = hift.m_source(s, self.sine_state)
+            s = s.transpose(1, 2)
+            self.source = s if self.source is None else torch.cat([self.source, s], dim=2)
+            self.n_source = end
+
+        # mel+source->speech, for the frames with all their decoder context
+        end = self.n_source if finalize else self.n_source - self.decode_context
+        if end <= self.n_out:
+            return self.mel.new_zeros(1, 0)
+        start = max(self.n_out - self.decode_context, 0)
+        stop = min(end + self.decode_context, self.n_source)
+        wav = hift.decode(x=self.mel[:, :, start:stop], s=self.source[:, :, start * hop_len:stop * hop_len])
+        wav = wav[:, (self.n_out - start) * hop_len:(end - start) * hop_len]
+        self.n_out = end
+        self.n_samples += wav.size(1)
+
+        # Drop the frames no later chunk needs as context
+        drop = max(min(self.n_out - self.decode_context, self.n_source - self.f0_context), 0)
+        self.mel, self.source = self.mel[:, :, drop:], self.source[:, :, drop * hop_len:]
+        self.n_source -= drop
+        self.n_out -= drop
+        return wav
@@ -134,6 +134,18 @@ class FeedForward(nn.Module):
         return hidden_states
 
 
+def unwrap_lora_linears(module: nn.Module):
+    "Replace the `LoRACompatibleLinear`s without a LoRA layer in `module` by plain `nn.Linear`s sharing their weights."
+    for name, child in list(module.named_children()):
+        if isinstance(child, LoRACompatibleLinear) and child.lora_layer is None:
+            linear = nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+            linear.weight = child.weight
+            linear.bias = child.bias
+            setattr(module, name, linear)
+        else:
+            unwrap_lora_linears(child)
+
+
 @maybe_allow_in_graph
 class BasicTransformerBlock(nn.Module):
     r"""
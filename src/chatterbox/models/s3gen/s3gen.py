@@ -17,6 +17,7 @@ import logging
 import numpy as np
 import torch
 import torchaudio as ta
+from torch.ao.quantization import quantize_dynamic
 from functools import lru_cache
 from typing import Optional
 
@@ -26,10 +27,11 @@ from .flow import CausalMaskedDiffWithXvec
 from .xvector import CAMPPlus
 from .utils.mel import mel_spectrogram
 from .f0_predictor import ConvRNNF0Predictor
-from .hifigan import HiFTGenerator
+from .hifigan import HiFTGenerator, HiFTStreamer
 from .transformer.upsample_encoder import UpsampleConformerEncoder
 from .flow_matching import CausalConditionalCFM
 from .decoder import ConditionalDecoder
+from .matcha.transformer import BasicTransformerBlock, unwrap_lora_linears
 from .configs import CFM_PARAMS
 
 
@@ -50,6 +52,11 @@ class S3Token2Mel(torch.nn.Module):
 
     TODO: make these modules configurable?
     """
+
+    # Keep the prompt-side work of the flow that doesn't depend on the new tokens in a pre-computed `ref_dict`, under
+    # "prompt_cache", so that later calls with the same voice skip it (see `CausalMaskedDiffWithXvec.embed_prompt`).
+    cache_prompt = True
+
     def __init__(self):
         super().__init__()
         self.tokenizer = S3Tokenizer("speech_tokenizer_v2_25hz")
@@ -104,6 +111,27 @@ class S3Token2Mel(torch.nn.Module):
         params = self.tokenizer.parameters()
         return next(params).device
 
+    def quantize_dynamic(self):
+        """
+        Replace the linear layers of the conformer encoder and of the transformer blocks of the CFM decoder with
+        int8 dynamically quantized ones, for CPU inference. The convolutions, the speaker encoder and the vocoder are
+        left in float.
+        """
+        assert self.device.type == "cpu", "dynamic quantization only runs on CPU"
+        quantize_dynamic(self.flow.encoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        blocks = [m for m in self.flow.decoder.estimator.modules() if isinstance(m, BasicTransformerBlock)]
+        for block in blocks:
+            # `quantize_dynamic` only swaps exact `nn.Linear`s
+            unwrap_lora_linears(block)
+            quantize_dynamic(block, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    def set_dtype(self, dtype):
+        """
+        Run the flow (conformer encoder and CFM estimator) in `dtype`, eg. `torch.bfloat16`. The tokenizer, speaker
+        encoder and mel extraction of the reference, as well as the ODE solver state, stay in float32.
+        """
+        self.flow.to(dtype=dtype)
+
     def embed_ref(
         self,
         ref_wav: torch.Tensor,
@@ -193,6 +221,8 @@ class S3Token2Mel(torch.nn.Module):
                     ref_dict[rk] = torch.from_numpy(ref_dict[rk])
                 if torch.is_tensor(ref_dict[rk]):
                     ref_dict[rk] = ref_dict[rk].to(self.device)
+            if self.cache_prompt:
+                ref_dict.setdefault("prompt_cache", {})
 
         if len(speech_tokens.shape) == 1:
             speech_tokens = speech_tokens.unsqueeze(0)
@@ -235,6 +265,20 @@ class S3Token2Wav(S3Token2Mel):
         trim_fade[n_trim:] = (torch.cos(torch.linspace(torch.pi, 0, n_trim)) + 1) / 2
         self.register_buffer("trim_fade", trim_fade, persistent=False) # (buffers get automatic device casting)
 
+    def fuse_vocoder(self):
+        "Fold the weight norms of the HiFT vocoder and precompute its Snake activations, see `HiFTGenerator.fuse`."
+        self.mel2wav.fuse()
+
+    def set_dtype(self, dtype):
+        """
+        Also run the convolution stack of the HiFT vocoder in `dtype`. The F0 predictor, the sine source and the
+        STFT / iSTFT stay in float32, they are sensitive to precision (phase accumulation, exp of the magnitude).
+        """
+        super().set_dtype(dtype)
+        hift = self.mel2wav
+        for module in (hift.conv_pre, hift.ups, hift.source_downs, hift.source_resblocks, hift.resblocks, hift.conv_post):
+            module.to(dtype=dtype)
+
     def forward(
         self,
         speech_tokens,
@@ -296,3 +340,38 @@ class S3Token2Wav(S3Token2Mel):
         output_wavs[:, :len(self.trim_fade)] *= self.trim_fade
 
         return output_wavs, output_sources
+
+    @torch.inference_mode()
+    def inference_chunk(
+        self,
+        speech_tokens,
+        ref_dict: dict,
+        mel_offset: int = 0,
+        hift_streamer: Optional[HiFTStreamer] = None,
+        finalize: bool = False,
+    ):
+        """
+        Streaming version of `inference`, which vocodes the speech tokens decoded so far from `mel_offset` on.
+
+        The flow is re-run on all the tokens (its encoder attends to the whole sequence), and the new mel frames are
+        passed to `hift_streamer`, which keeps the vocoder's context between chunks and holds back the last frames
+        until it has enough of it (see `HiFTStreamer`).
+
+        Returns:
+            wav: (1, num_samples) waveform chunk
+            mel_offset: offset for the next chunk
+            hift_streamer: vocoder state for the next chunk
+        """
+        output_mels = self.flow_inference(speech_tokens, ref_dict=ref_dict, finalize=finalize)
+        next_mel_offset = output_mels.shape[2]
+
+        if hift_streamer is None:
+            hift_streamer = HiFTStreamer(self.mel2wav)
+        output_wavs = hift_streamer.push(output_mels[:, :, mel_offset:], finalize=finalize)
+
+        # NOTE: ad-hoc method to reduce "spillover" from the reference clip.
+        start = hift_streamer.n_samples - output_wavs.shape[1]
+        n_fade = max(min(len(self.trim_fade) - start, output_wavs.shape[1]), 0)
+        output_wavs[:, :n_fade] *= self.trim_fade[start:start + n_fade]
+
+        return output_wavs, next_mel_offset, hift_streamer
@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
 from torch import nn
@@ -240,6 +240,7 @@ class UpsampleConformerEncoder(torch.nn.Module):
         xs_lens: torch.Tensor,
         decoding_chunk_size: int = 0,
         num_decoding_left_chunks: int = -1,
+        prompt_xs: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Embed positions in tensor.
 
@@ -254,6 +255,9 @@ class UpsampleConformerEncoder(torch.nn.Module):
             the chunk size is decoding_chunk_size.
                 >=0: use num_decoding_left_chunks
                 <0: use all left chunks
+            prompt_xs: output of `embed_prompt` for the leading frames of the
+                sequences, which are then left out of `xs` (`xs_lens` still
+                counts them)
         Returns:
             encoder output tensor xs, and subsampled masks
             xs: padded output tensor (B, T' ~= T/subsample_rate, D)
@@ -264,11 +268,16 @@ class UpsampleConformerEncoder(torch.nn.Module):
             checkpointing API because `__call__` attaches all the hooks of the module.
             https://discuss.pytorch.org/t/any-different-between-model-input-and-model-forward-input/3690/2
         """
+        if prompt_xs is not None:
+            xs = torch.cat([prompt_xs, self.embed.out(xs)], dim=1)
         T = xs.size(1)
         masks = ~make_pad_mask(xs_lens, T).unsqueeze(1)  # (B, 1, T)
-        if self.global_cmvn is not None:
-            xs = self.global_cmvn(xs)
-        xs, pos_emb, masks = self.embed(xs, masks)
+        if prompt_xs is not None:
+            xs, pos_emb = self.embed.pos_enc(xs)
+        else:
+            if self.global_cmvn is not None:
+                xs = self.global_cmvn(xs)
+            xs, pos_emb, masks = self.embed(xs, masks)
         mask_pad = masks  # (B, 1, T/subsample_rate)
         chunk_masks = add_optional_chunk_mask(xs, masks,
                                               self.use_dynamic_chunk,
@@ -303,6 +312,16 @@ class UpsampleConformerEncoder(torch.nn.Module):
         # for cross attention with decoder later
         return xs, masks
 
+    def embed_prompt(self, xs: torch.Tensor) -> torch.Tensor:
+        """Input layer of `forward` for the leading (prompt) frames `xs`,
+        before the positional encoding. The layer is position-wise, so the
+        result can be computed once and passed to `forward` as `prompt_xs`.
+        The rest of the encoder attends over the whole sequence and has to
+        run on the prompt again.
+        """
+        assert self.global_cmvn is None
+        return self.embed.out(xs)
+
     def forward_layers(self, xs: torch.Tensor, chunk_masks: torch.Tensor,
                        pos_emb: torch.Tensor,
                        mask_pad: torch.Tensor) -> torch.Tensor:
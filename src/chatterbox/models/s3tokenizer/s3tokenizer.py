@@ -4,7 +4,7 @@ import numpy as np
 import librosa
 import torch
 import torch.nn.functional as F
-from s3tokenizer.utils import padding
+from torch.nn.utils.rnn import pad_sequence
 from s3tokenizer.model_v2 import (
     S3TokenizerV2,
     ModelConfig,
@@ -24,6 +24,7 @@ class S3Tokenizer(S3TokenizerV2):
     s3tokenizer.S3TokenizerV2 with the following changes:
     - a more integrated `forward`
     - compute `log_mel_spectrogram` using `_mel_filters` and `window` in `register_buffers`
+    - `batch_log_mel_spectrogram` computes the log-mels of a whole batch of wavs at once
     """
 
     ignore_state_dict_missing = ("_mel_filters", "window")
@@ -104,22 +105,19 @@ class S3Tokenizer(S3TokenizerV2):
         - `max_len` max length to truncate the output sequence to (25 token/sec).
         NOTE: please pad the waveform if longer sequence is needed.
         """
-        processed_wavs = self._prepare_audio(wavs)
-        mels, mel_lens = [], []
-        for wav in processed_wavs:
-            wav = wav.to(self.device)
-            mel = self.log_mel_spectrogram(wav)  # [B=1, F, T]
-            if max_len is not None:
-                mel = mel[..., :max_len * 4]  # num_mel_frames = 4 * num_tokens
-            mels.append(mel.squeeze(0))
-
-        mels, mel_lens = padding(mels)
+        processed_wavs = [wav.to(self.device) for wav in self._prepare_audio(wavs)]
+        mels, mel_lens = self.batch_log_mel_spectrogram(processed_wavs)
+        if max_len is not None:
+            # num_mel_frames = 4 * num_tokens
+            mels = mels[..., :max_len * 4]
+            mel_lens = mel_lens.clamp(max=max_len * 4)
+
         if accelerator is None:
             tokenizer = self
         else:
             tokenizer = accelerator.unwrap_model(self)
 
-        speech_tokens, speech_token_lens = tokenizer.quantize(mels, mel_lens.to(self.device))
+        speech_tokens, speech_token_lens = tokenizer.quantize(mels, mel_lens)
         return (
             speech_tokens.long().detach(),
             speech_token_lens.long().detach(),
@@ -155,14 +153,62 @@ class S3Tokenizer(S3TokenizerV2):
             audio = F.pad(audio, (0, padding))
         stft = torch.stft(
             audio, self.n_fft, S3_HOP,
-            window=self.window.to(self.device),
+            window=self.window,
             return_complex=True
         )
         magnitudes = stft[..., :-1].abs()**2
 
-        mel_spec = self._mel_filters.to(self.device) @ magnitudes
+        mel_spec = self._mel_filters @ magnitudes
 
         log_spec = torch.clamp(mel_spec, min=1e-10).log10()
         log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
         log_spec = (log_spec + 4.0) / 4.0
         return log_spec
+
+    def batch_log_mel_spectrogram(
+        self,
+        wavs: List[torch.Tensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        `log_mel_spectrogram` of a list of 16 kHz wavs of different lengths, with one STFT and one mel matmul for the
+        whole batch.
+
+        Each wav is reflect-padded by `n_fft // 2` on both sides, as `torch.stft(center=True)` does, before the batch is
+        zero-padded, so that the frames next to the end of a short wav are the same as when computed alone. The
+        dynamic range clamp uses the max of each utterance over its own frames.
+
+        Parameters
+        ----------
+        wavs: List[torch.Tensor], shape = (1, T) or (T,)
+            The waveforms, on the device of the tokenizer
+
+        Returns
+        -------
+        torch.Tensor, shape = (B, 128, n_frames)
+            The log-Mel spectrograms, zero-padded
+        torch.Tensor, shape = (B,)
+            The number of frames of each of them
+        """
+        pad = self.n_fft // 2
+        wavs = [wav.reshape(1, -1) for wav in wavs]
+        wav_lens = torch.tensor([wav.shape[1] for wav in wavs], device=self.device)
+        audio = pad_sequence([F.pad(wav, (pad, pad), mode="reflect")[0] for wav in wavs], batch_first=True)
+        stft = torch.stft(
+            audio, self.n_fft, S3_HOP,
+            window=self.window,
+            center=False,
+            return_complex=True
+        )
+        # Same frames as `log_mel_spectrogram`, which drops the last one of each wav
+        magnitudes = stft[..., :-1].abs()**2
+        mel_lens = wav_lens // S3_HOP
+
+        mel_spec = self._mel_filters @ magnitudes
+
+        log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+        mask = torch.arange(log_spec.shape[2], device=self.device) < mel_lens[:, None]
+        mask = mask.unsqueeze(1)  # (B, 1, n_frames)
+        log_max = log_spec.masked_fill(~mask, -float("inf")).amax(dim=(1, 2), keepdim=True)
+        log_spec = torch.maximum(log_spec, log_max - 8.0)
+        log_spec = ((log_spec + 4.0) / 4.0).masked_fill(~mask, 0.0)
+        return log_spec, mel_lens.int()
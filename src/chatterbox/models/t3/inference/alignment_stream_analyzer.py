@@ -81,6 +81,14 @@ class AlignmentStreamAnalyzer:
         original_forward = target_layer.forward
         def patched_forward(self, *args, **kwargs):
             kwargs['output_attentions'] = True
+            # With SDPA and no padding, the model passes no mask and relies on `is_causal`, but the eager
+            # fallback of this layer needs an explicit causal mask for the prefill
+            hidden_states = kwargs.get('hidden_states', args[0] if args else None)
+            q_len = hidden_states.size(1)
+            if kwargs.get('attention_mask') is None and q_len > 1:
+                min_value = torch.finfo(hidden_states.dtype).min
+                causal_mask = torch.full((q_len, q_len), min_value, dtype=hidden_states.dtype, device=hidden_states.device)
+                kwargs['attention_mask'] = causal_mask.triu(1)[None, None]
             return original_forward(*args, **kwargs)
 
         # TODO: how to unpatch it?
@@ -0,0 +1,163 @@
+from typing import List, Optional, Tuple
+
+import torch
+from torch import Tensor
+from transformers import LlamaConfig
+from transformers.cache_utils import Cache
+
+
+def _head_dim(cfg: LlamaConfig):
+    return getattr(cfg, "head_dim", None) or cfg.hidden_size // cfg.num_attention_heads
+
+
+class StaticKVCache(Cache):
+    """
+    Preallocated KV cache for `T3.inference`. Every layer holds `max_len` positions from the start and all rows
+    share the same length, so decode steps write the new K/V in place instead of concatenating to the cache.
+    `update` returns views of the filled part only, attention doesn't run over the unused positions.
+    """
+
+    def __init__(self, n_layers, batch_size, n_heads, head_dim, max_len, dtype, device):
+        super().__init__()
+        shape = (batch_size, n_heads, max_len, head_dim)
+        self.key_cache: List[Tensor] = [torch.empty(shape, dtype=dtype, device=device) for _ in range(n_layers)]
+        self.value_cache: List[Tensor] = [torch.empty(shape, dtype=dtype, device=device) for _ in range(n_layers)]
+        self.max_len = max_len
+        self.seq_len = 0
+
+    @classmethod
+    def from_config(cls, cfg: LlamaConfig, batch_size, max_len, dtype, device):
+        return cls(cfg.num_hidden_layers, batch_size, cfg.num_key_value_heads, _head_dim(cfg), max_len, dtype, device)
+
+    def __len__(self):
+        # like `DynamicCache`, an empty cache has no layers
+        return len(self.key_cache) if self.seq_len > 0 else 0
+
+    def set_prefix(self, prefix: List[Tuple[Tensor, Tensor]]):
+        """
+        Start from precomputed per-layer (n, H, P, D) keys / values, eg. a cached conditioning prefix. Row `i` of the
+        cache gets row `i % n` of the prefix, so a prefix of the N conds is repeated for the CFG rows.
+        """
+        length = prefix[0][0].size(2)
+        assert length <= self.max_len
+        for layer, (k, v) in enumerate(prefix):
+            n = k.size(0)
+            self.key_cache[layer][:, :, :length].unflatten(0, (-1, n))[:] = k
+            self.value_cache[layer][:, :, :length].unflatten(0, (-1, n))[:] = v
+        self.seq_len = length
+
+    # in-place writes to inference tensors can't be traced, run them eagerly when the backend is compiled
+    @torch.compiler.disable
+    def update(self, key_states: Tensor, value_states: Tensor, layer_idx: int, cache_kwargs=None):
+        start = self.seq_len
+        end = start + key_states.shape[2]
+        assert end <= self.max_len, f"KV cache is full ({self.max_len} positions)"
+        self.key_cache[layer_idx][:, :, start:end] = key_states
+        self.value_cache[layer_idx][:, :, start:end] = value_states
+        if layer_idx == len(self.key_cache) - 1:
+            self.seq_len = end
+        return self.key_cache[layer_idx][:, :, :end], self.value_cache[layer_idx][:, :, :end]
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self.seq_len
+
+    def get_max_cache_shape(self) -> Optional[int]:
+        return self.max_len
+
+    def crop(self, max_length: int):
+        "Drop the positions after `max_length`, eg. rejected draft tokens. Like `DynamicCache.crop`."
+        self.seq_len = min(self.seq_len, max_length)
+
+
+class SlotKVCache(Cache):
+    """
+    Preallocated KV cache for a fixed number of decode slots. Every slot owns two rows, ie. the (cond, uncond) pair
+    used for CFG, and each row has its own length, so slots can be (re)filled independently of each other.
+
+    One decode step goes like:
+        - `begin_step(n_rows)` returns the position ids and the attention mask of the first `n_rows` rows
+        - the transformer calls `update` once per layer, writing the new K/V of each row at its own length
+        - `end_step()` advances the lengths of those rows
+    """
+
+    def __init__(self, n_layers, n_slots, n_heads, head_dim, dtype, device, block_size=256):
+        super().__init__()
+        self.n_rows = 2 * n_slots
+        self.block_size = block_size
+        self.dtype = dtype
+        self.device = device
+        self.capacity = block_size
+        shape = (self.n_rows, n_heads, self.capacity, head_dim)
+        self.key_cache: List[Tensor] = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(n_layers)]
+        self.value_cache: List[Tensor] = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(n_layers)]
+        self.lens = torch.zeros(self.n_rows, dtype=torch.long, device=device)
+        self._step_rows = 0
+        self._step_len = 0
+
+    @classmethod
+    def from_config(cls, cfg: LlamaConfig, n_slots, dtype, device):
+        return cls(cfg.num_hidden_layers, n_slots, cfg.num_key_value_heads, _head_dim(cfg), dtype, device)
+
+    def __len__(self):
+        return len(self.key_cache)
+
+    def _reserve(self, length):
+        "Grow every layer to hold at least `length` positions, in whole blocks."
+        if length <= self.capacity:
+            return
+        n_blocks = -(-length // self.block_size)
+        extra = n_blocks * self.block_size - self.capacity
+        for cache in (self.key_cache, self.value_cache):
+            for i, layer in enumerate(cache):
+                cache[i] = torch.cat([layer, layer.new_zeros(*layer.shape[:2], extra, layer.shape[3])], dim=2)
+        self.capacity += extra
+
+    def load_slot(self, slot: int, prefix: Cache):
+        "Copy the (2, H, P, D) prefill cache of one request into the rows of `slot`."
+        length = prefix.get_seq_length()
+        self._reserve(length)
+        rows = slice(2 * slot, 2 * slot + 2)
+        for layer, (k, v) in enumerate(zip(prefix.key_cache, prefix.value_cache)):
+            self.key_cache[layer][rows, :, :length] = k[:, :, :length]
+            self.value_cache[layer][rows, :, :length] = v[:, :, :length]
+        self.lens[rows] = length
+
+    def free_slot(self, slot: int):
+        # stale K/V is simply masked out, no need to clear it
+        self.lens[2 * slot: 2 * slot + 2] = 0
+
+    def begin_step(self, n_rows: int):
+        """
+        Returns:
+            position_ids: (n_rows, 1) RoPE position of the new token of each row
+            attention_mask: (n_rows, 1, 1, L) additive mask over the cached positions plus the new one
+        """
+        lens = self.lens[:n_rows]
+        self._step_rows = n_rows
+        self._step_len = int(lens.max()) + 1
+        self._reserve(self._step_len)
+
+        positions = torch.arange(self._step_len, device=self.device)
+        visible = positions[None] <= lens[:, None]  # (n_rows, L)
+        attention_mask = torch.zeros(visible.shape, dtype=self.dtype, device=self.device)
+        attention_mask.masked_fill_(~visible, torch.finfo(self.dtype).min)
+        return lens.view(n_rows, 1), attention_mask.view(n_rows, 1, 1, self._step_len)
+
+    def end_step(self):
+        self.lens[:self._step_rows] += 1
+
+    # in-place writes to inference tensors can't be traced, run them eagerly when the backend is compiled
+    @torch.compiler.disable
+    def update(self, key_states: Tensor, value_states: Tensor, layer_idx: int, cache_kwargs=None):
+        n, L = self._step_rows, self._step_len
+        rows = torch.arange(n, device=self.device)
+        pos = self.lens[:n]
+        self.key_cache[layer_idx][rows, :, pos] = key_states[:, :, 0]
+        self.value_cache[layer_idx][rows, :, pos] = value_states[:, :, 0]
+        return self.key_cache[layer_idx][:n, :, :L], self.value_cache[layer_idx][:n, :, :L]
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self._step_len - 1
+
+    def get_max_cache_shape(self) -> Optional[int]:
+        return None
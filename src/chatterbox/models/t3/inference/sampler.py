@@ -0,0 +1,73 @@
+import math
+
+import torch
+from torch import Tensor
+
+
+class T3Sampler:
+    """
+    Samples the next speech token of each row from its (N, V) logits, replacing the HF `RepetitionPenaltyLogitsProcessor`,
+    `MinPLogitsWarper` and `TopPLogitsWarper` chain with the same semantics:
+
+    - the tokens generated so far are tracked in an (N, V) mask updated with each sampled token, instead of gathering
+      over the whole `generated_ids` every step (the HF penalty also applies once per token, whatever its count);
+    - min-p is a threshold on the logits, `logit < max_logit + log(min_p)`, without a softmax;
+    - top-p only sorts the tokens that survived min-p (a few dozen out of the 8194 speech tokens) with `topk`;
+    - stages that are no-ops for the given parameters (temperature 1, no penalty, min-p 0, top-p 1) are skipped.
+    """
+
+    def __init__(
+        self,
+        n_rows,
+        vocab_size,
+        *,
+        temperature=0.8,
+        min_p=0.05,
+        top_p=1.0,
+        repetition_penalty=1.2,
+        device=None,
+    ):
+        self.temperature = temperature
+        self.min_p = min_p
+        self.top_p = top_p
+        self.repetition_penalty = float(repetition_penalty)
+        self.seen = torch.zeros(n_rows, vocab_size, dtype=torch.bool, device=device)
+
+    def observe(self, tokens: Tensor):
+        "Mark the (N, 1) `tokens` as generated, for the repetition penalty."
+        self.seen.scatter_(1, tokens.view(-1, 1), True)
+
+    def warp(self, logits: Tensor) -> Tensor:
+        "The filtered (N, V) logits to sample from, masked tokens are set to -inf."
+        logits = logits.float()
+        if self.temperature != 1.0:
+            logits = logits / self.temperature
+        else:
+            logits = logits.clone()
+
+        if self.repetition_penalty != 1.0:
+            penalized = torch.where(logits < 0, logits * self.repetition_penalty, logits / self.repetition_penalty)
+            logits = torch.where(self.seen, penalized, logits)
+
+        if self.min_p > 0.0:
+            # p < min_p * p_max  <=>  logit < logit_max + log(min_p)
+            threshold = logits.amax(dim=-1, keepdim=True) + math.log(self.min_p)
+            logits.masked_fill_(logits < threshold, -float("inf"))
+
+        if self.top_p < 1.0:
+            # Partial sort over the candidates left, the most probable one is always kept
+            k = int(torch.isfinite(logits).sum(dim=-1).max())
+            top_logits, top_idx = logits.topk(k, dim=-1)
+            top_probs = torch.softmax(top_logits, dim=-1)
+            mass_before = top_probs.cumsum(dim=-1) - top_probs
+            remove = mass_before >= self.top_p
+            logits.scatter_(1, top_idx, top_logits.masked_fill(remove, -float("inf")))
+
+        return logits
+
+    def __call__(self, logits: Tensor) -> Tensor:
+        "Sample (N, 1) tokens from the (N, V) logits and mark them as generated."
+        probs = torch.softmax(self.warp(logits), dim=-1)
+        next_token = torch.multinomial(probs, num_samples=1)
+        self.observe(next_token)
+        return next_token
@@ -0,0 +1,251 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+
+import torch
+from torch import Tensor
+
+from ..modules.cond_enc import T3Cond
+from .kv_cache import SlotKVCache
+from .sampler import T3Sampler
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class T3Request:
+    t3_cond: T3Cond
+    text_tokens: Tensor  # (1, T)
+    max_new_tokens: int
+    temperature: float
+    min_p: float
+    top_p: float
+    repetition_penalty: float
+    cfg_weight: float
+    future: Future = field(default_factory=Future)
+    # if set, every sampled (1, 1) token is also put here, followed by None when the request is done
+    token_queue: Optional[queue.Queue] = None
+
+    # decode state
+    generated: List[Tensor] = field(default_factory=list)
+    sampler: Optional[T3Sampler] = None
+
+
+class T3Scheduler:
+    """
+    Continuous batching in front of `T3`: requests are decoded together in up to `max_batch_size` slots, and a
+    waiting request takes over a slot as soon as the utterance in it emits `stop_speech_token`, instead of
+    waiting for the whole batch to finish.
+
+    Each request is prefilled on its own (the prompts have different lengths), then its KV cache is copied into
+    a free slot of a shared `SlotKVCache`. Decode steps run over the rows of all slots up to the highest one in
+    use. Every request keeps its own sampling parameters and CFG weight.
+
+    The scheduler owns the T3 model while it runs: don't call `T3.inference` concurrently from other threads.
+    """
+
+    def __init__(self, t3, max_batch_size=4):
+        self.t3 = t3
+        self.hp = t3.hp
+        self.max_batch_size = max_batch_size
+        self.slots: List[Optional[T3Request]] = [None] * max_batch_size
+        self.pending = queue.Queue()
+        self.kv_cache = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="T3Scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        t3_cond: T3Cond,
+        text_tokens: Tensor,
+        *,
+        max_new_tokens=None,
+        temperature=0.8,
+        min_p=0.05,
+        top_p=1.0,
+        repetition_penalty=1.2,
+        cfg_weight=0.5,
+        token_queue: Optional[queue.Queue] = None,
+    ) -> Future:
+        """
+        Queue one utterance for decoding.
+
+        Args:
+            t3_cond: the voice conditioning of this utterance
+            text_tokens: (T,) or (1, T) text tokens, including the start / stop text tokens
+            token_queue: optional queue receiving each (1, 1) token as it's sampled, then None
+
+        Returns:
+            a future resolving to the (1, T) predicted speech tokens, ending with `stop_speech_token` unless
+            `max_new_tokens` was reached first
+        """
+        assert not self._closed, "scheduler is closed"
+        req = T3Request(
+            t3_cond=t3_cond,
+            text_tokens=torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.t3.device),
+            max_new_tokens=max_new_tokens or self.hp.max_speech_tokens,
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            cfg_weight=cfg_weight,
+            token_queue=token_queue,
+        )
+        self.pending.put(req)
+        return req.future
+
+    def submit_stream(self, t3_cond: T3Cond, text_tokens: Tensor, **kwargs) -> Iterator[Tensor]:
+        """
+        Same as `submit`, but yields the (1, 1) speech tokens of the utterance as they are decoded.
+        """
+        token_queue = queue.Queue()
+        future = self.submit(t3_cond, text_tokens, token_queue=token_queue, **kwargs)
+        while (token := token_queue.get()) is not None:
+            yield token
+        future.result()  # re-raise decoding errors
+
+    def close(self):
+        self._closed = True
+        self.pending.put(None)
+        self._thread.join()
+
+    @torch.inference_mode()
+    def _run(self):
+        while True:
+            # Block only when there is nothing to decode
+            busy = any(req is not None for req in self.slots)
+            try:
+                while None in self.slots:
+                    req = self.pending.get(block=not busy)
+                    if req is None:
+                        self._fail_all(RuntimeError("scheduler is closed"))
+                        return
+                    self._admit(req)
+                    busy = any(req is not None for req in self.slots)
+            except queue.Empty:
+                pass
+
+            if any(req is not None for req in self.slots):
+                try:
+                    self._step()
+                except Exception as e:
+                    logger.exception("T3 decode step failed")
+                    self._fail_all(e)
+
+    def _fail_all(self, exc):
+        for slot, req in enumerate(self.slots):
+            if req is not None:
+                self._finish(req, exc=exc)
+                self._release(slot)
+
+    @staticmethod
+    def _finish(req: T3Request, exc=None):
+        if exc is not None:
+            req.future.set_exception(exc)
+        else:
+            req.future.set_result(torch.cat(req.generated[1:], dim=1))
+        if req.token_queue is not None:
+            req.token_queue.put(None)
+
+    def _release(self, slot):
+        self.slots[slot] = None
+        if self.kv_cache is not None:
+            self.kv_cache.free_slot(slot)
+
+    def _admit(self, req: T3Request):
+        if not req.future.set_running_or_notify_cancel():
+            if req.token_queue is not None:
+                req.token_queue.put(None)
+            return
+        try:
+            self._prefill(req)
+        except Exception as e:
+            logger.exception("T3 prefill failed")
+            self._finish(req, exc=e)
+
+    def _prefill(self, req: T3Request):
+        t3 = self.t3
+
+        # Slots always hold two rows: the (cond, uncond) pair with CFG, otherwise the uncond row is a copy of the
+        # cond one and is ignored
+        output = t3.prefill(
+            t3_cond=req.t3_cond,
+            text_tokens=torch.cat([req.text_tokens, req.text_tokens]),
+            cfg_weight=req.cfg_weight,
+        )
+
+        if self.kv_cache is None:
+            k = output.past.key_cache[0]
+            self.kv_cache = SlotKVCache.from_config(t3.cfg, self.max_batch_size, k.dtype, k.device)
+
+        slot = self.slots.index(None)
+        self.kv_cache.load_slot(slot, output.past)
+        self.slots[slot] = req
+        bos = torch.full((1, 1), self.hp.start_speech_token, dtype=torch.long, device=t3.device)
+        req.generated.append(bos)
+        req.sampler = T3Sampler(
+            1,
+            output.logits.size(-1),
+            temperature=req.temperature,
+            min_p=req.min_p,
+            top_p=req.top_p,
+            repetition_penalty=req.repetition_penalty,
+            device=t3.device,
+        )
+        req.sampler.observe(bos)
+        self._sample(slot, req, output.logits)
+
+    def _step(self):
+        t3 = self.t3
+        n_slots = max(i for i, req in enumerate(self.slots) if req is not None) + 1
+        n_rows = 2 * n_slots
+
+        # Free slots below the highest busy one just decode a dummy token
+        tokens = torch.full((n_slots, 1), self.hp.stop_speech_token, dtype=torch.long, device=t3.device)
+        steps = torch.zeros((n_slots, 1), dtype=torch.long, device=t3.device)
+        for slot, req in enumerate(self.slots[:n_slots]):
+            if req is not None:
+                tokens[slot] = req.generated[-1][0]
+                steps[slot] = len(req.generated) - 1
+
+        embeds = t3.speech_emb(tokens) + t3.speech_pos_emb.get_fixed_embedding(steps)
+        embeds = embeds.repeat_interleave(2, dim=0)  # (n_rows, 1, dim), cond / uncond rows interleaved
+
+        position_ids, attention_mask = self.kv_cache.begin_step(n_rows)
+        output = self.t3.get_backend()(
+            inputs_embeds=embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.kv_cache,
+            use_cache=True,
+            return_dict=True,
+        )
+        self.kv_cache.end_step()
+
+        logits = output.logits[:, -1, :]
+        for slot, req in enumerate(self.slots[:n_slots]):
+            if req is not None:
+                self._sample(slot, req, logits[2 * slot: 2 * slot + 2])
+
+    def _sample(self, slot, req: T3Request, logits: Tensor):
+        "Sample the next token of `req` from its (2, V) cond / uncond logits, and retire it when it's done."
+        logits_cond, logits_uncond = logits[:1], logits[1:]
+        if req.cfg_weight > 0.0:
+            logits = logits_cond + req.cfg_weight * (logits_cond - logits_uncond)
+        else:
+            logits = logits_cond
+
+        next_token = req.sampler(logits)  # (1, 1)
+        req.generated.append(next_token)
+        if req.token_queue is not None:
+            req.token_queue.put(next_token)
+
+        n_predicted = len(req.generated) - 1
+        if next_token.item() == self.hp.stop_speech_token or n_predicted >= req.max_new_tokens:
+            self._finish(req)
+            self._release(slot)
@@ -0,0 +1,49 @@
+from typing import List
+
+import torch
+from torch import Tensor
+
+
+class NgramDrafter:
+    """
+    Draft speech tokens for speculative decoding by prompt lookup: find the latest earlier occurrence of the last
+    `n` tokens (longest `n` first, down to `min_ngram`) in the history, and propose the tokens that followed it.
+    The history starts with the voice's prompt speech tokens, if any, and grows with every accepted token.
+    """
+
+    def __init__(self, history: List[int], max_ngram=3, min_ngram=1):
+        self.history = list(history)
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+
+    def append(self, token: int):
+        self.history.append(token)
+
+    def propose(self, n_tokens: int) -> List[int]:
+        h = self.history
+        for n in range(min(self.max_ngram, len(h) - 1), self.min_ngram - 1, -1):
+            suffix = h[-n:]
+            # latest match first, the match must be followed by at least one token
+            for start in range(len(h) - n - 1, -1, -1):
+                if h[start:start + n] == suffix:
+                    return h[start + n:start + n + n_tokens]
+        return []
+
+
+def accept_draft(probs: Tensor, draft_token: int):
+    """
+    Speculative sampling for a deterministic draft: keep `draft_token` with probability `probs[draft_token]`,
+    otherwise sample from `probs` without it. The result is distributed exactly as a sample from `probs`.
+
+    Args:
+        probs: (V,) target distribution at this position
+
+    Returns:
+        (accepted, token)
+    """
+    p = probs[draft_token]
+    if torch.rand((), device=probs.device) < p:
+        return True, draft_token
+    residual = probs.clone()
+    residual[draft_token] = 0
+    return False, int(torch.multinomial(residual, num_samples=1))
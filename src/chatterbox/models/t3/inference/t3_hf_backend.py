@@ -73,10 +73,12 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
     def forward(
         self,
         inputs_embeds: torch.Tensor,
+        attention_mask: Optional[torch.Tensor]=None,
         past_key_values: Optional[torch.Tensor]=None,
+        position_ids: Optional[torch.Tensor]=None,
         use_cache=True,
         output_attentions=False,
-        output_hidden_states=True,
+        output_hidden_states=False,
         return_dict=True,
     ):
         """
@@ -84,29 +86,33 @@ class T3HuggingfaceBackend(LlamaPreTrainedModel, GenerationMixin):
         Overridden here to apply our custom layer norm and speech logit projection layers.
 
         :param inputs_embeds: (B, S, C) float32 tensor of conditioning inputs. If past key values are given,
-        S should be 1.
+        S is 1, or the length of the prompt after a cached prefix.
+        :param attention_mask: optional (B, past + S) mask, 0 for (left) padding positions.
+        :param position_ids: optional (B, S) positions, for rows that don't share the same cache length.
+
+        Only the final hidden state is needed for the logits: leave `output_attentions` and `output_hidden_states`
+        off unless the caller uses them, `output_attentions` forces the eager attention path in every layer.
         """
-        is_large_input = inputs_embeds.size(1) != 1
-        has_cache = past_key_values is not None and len(past_key_values) > 0
-        assert not (is_large_input and has_cache)
         assert return_dict
-        assert output_hidden_states
 
         tfmr_out = self.model(
             inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
             past_key_values=past_key_values,
+            position_ids=position_ids,
             use_cache=use_cache,
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=True,
         )
-        hidden_states = tfmr_out.hidden_states[-1]  # (B, seq, dim)
+        hidden_states = tfmr_out.last_hidden_state  # (B, seq, dim), same as `tfmr_out.hidden_states[-1]`
 
-        logits = self.speech_head(hidden_states)
+        logits = self.speech_head(hidden_states.to(self.speech_head.weight.dtype))
         # assert inputs_embeds.size(0) == 1 # (disabled for CFG)
 
         # NOTE: hallucination handler may modify logits to force emit an EOS token
-        # logits = self.alignment_stream_analyzer.step(logits)
+        if self.alignment_stream_analyzer is not None:
+            logits = self.alignment_stream_analyzer.step(logits)
 
         return CausalLMOutputWithCrossAttentions(
             logits=logits,
@@ -66,8 +66,9 @@ class T3CondEnc(nn.Module):
         assert (cond.cond_prompt_speech_tokens is None) == (cond.cond_prompt_speech_emb is None), \
             "no embeddings for cond_prompt_speech_tokens"
 
-        # Speaker embedding projection
-        cond_spkr = self.spkr_enc(cond.speaker_emb.view(-1, self.hp.speaker_embed_size))[:, None]  # (B, 1, dim)
+        # Speaker embedding projection, conds are float32 even if the model isn't
+        dtype = self.spkr_enc.weight.dtype
+        cond_spkr = self.spkr_enc(cond.speaker_emb.view(-1, self.hp.speaker_embed_size).to(dtype))[:, None]  # (B, 1, dim)
         empty = torch.zeros_like(cond_spkr[:, :0])  # (B, 0, dim)
 
         # TODO CLAP
@@ -78,14 +79,16 @@ class T3CondEnc(nn.Module):
         cond_prompt_speech_emb = cond.cond_prompt_speech_emb
         if cond_prompt_speech_emb is None:
             cond_prompt_speech_emb = empty  # (B, 0, dim)
-        elif self.hp.use_perceiver_resampler:
-            cond_prompt_speech_emb = self.perceiver(cond_prompt_speech_emb)
+        else:
+            cond_prompt_speech_emb = cond_prompt_speech_emb.to(dtype)
+            if self.hp.use_perceiver_resampler:
+                cond_prompt_speech_emb = self.perceiver(cond_prompt_speech_emb)
 
         # Emotion Adv: must provide a value if this model uses emotion conditioning
         cond_emotion_adv = empty  # (B, 0, dim)
         if self.hp.emotion_adv:
             assert cond.emotion_adv is not None
-            cond_emotion_adv = self.emotion_adv_fc(cond.emotion_adv.view(-1, 1, 1))
+            cond_emotion_adv = self.emotion_adv_fc(cond.emotion_adv.view(-1, 1, 1).to(dtype))
 
         # Concat and return
         cond_embeds = torch.cat((
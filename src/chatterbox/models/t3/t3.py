@@ -1,14 +1,17 @@
 # Copyright (c) 2025 Resemble AI
 # MIT License
+import copy
+import hashlib
 import logging
-from typing import Union, Optional, List
+import threading
+from collections import OrderedDict
+from typing import Union, Optional, List, Tuple
 
 from tqdm import tqdm
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
 from transformers import LlamaModel, LlamaConfig
-from transformers.generation.logits_process import MinPLogitsWarper, RepetitionPenaltyLogitsProcessor, TopPLogitsWarper
 
 from .modules.learned_pos_emb import LearnedPositionEmbeddings
 
@@ -16,12 +19,25 @@ from .modules.cond_enc import T3CondEnc, T3Cond
 from .modules.t3_config import T3Config
 from .llama_configs import LLAMA_CONFIGS
 from .inference.t3_hf_backend import T3HuggingfaceBackend
+from .inference.kv_cache import StaticKVCache
+from .inference.sampler import T3Sampler
+from .inference.speculative import NgramDrafter, accept_draft
 from ..utils import AttrDict
 
 
 logger = logging.getLogger(__name__)
 
 
+def _truncated_llama(llama: LlamaModel, num_layers: int) -> LlamaModel:
+    "A view of `llama` running only its first `num_layers` layers, followed by its final norm. Weights are shared."
+    truncated = copy.copy(llama)
+    truncated._modules = dict(llama._modules)
+    truncated.layers = nn.ModuleList(llama.layers[:num_layers])
+    truncated.config = copy.copy(llama.config)
+    truncated.config.num_hidden_layers = num_layers
+    return truncated
+
+
 def _ensure_BOT_EOT(text_tokens: Tensor, hp):
     B = text_tokens.size(0)
     assert (text_tokens == hp.start_text_token).int().sum() >= B, "missing start_text_token"
@@ -38,6 +54,9 @@ class T3(nn.Module):
             different PE embedding space for speech.
     """
 
+    # Max number of voices whose conditioning prefix KV is kept, see `cond_prefix`. 0 disables the cache.
+    prefix_cache_size = 16
+
     def __init__(self, hp=T3Config()):
         super().__init__()
         self.hp = hp
@@ -63,48 +82,145 @@ class T3(nn.Module):
         self.text_head = nn.Linear(self.cfg.hidden_size, hp.text_tokens_dict_size, bias=False)
         self.speech_head = nn.Linear(self.cfg.hidden_size, hp.speech_tokens_dict_size, bias=False)
         self.compiled = False
+        self.compile_lock = threading.Lock()
+        self.reduced_backends = {}
+        self.prefix_cache = OrderedDict()
+        self.prefix_lock = threading.Lock()
 
     @property
     def device(self):
         return self.speech_head.weight.device
 
-    def prepare_conditioning(self, t3_cond: T3Cond):
+    def get_backend(self, num_layers: Optional[int]=None) -> T3HuggingfaceBackend:
+        """
+        The HF backend that `inference` decodes with. It's built on first use and shared by all later calls (and
+        threads), instead of re-running the `LlamaPreTrainedModel` init machinery for every utterance.
+
+        Args:
+            num_layers: run only the first `num_layers` Llama layers, the final norm and `speech_head` being applied
+                to the output of the last one. Trades quality for speed, see `bench_t3_depth.py`. Defaults to all
+                layers; reduced depth backends aren't compiled.
+        """
+        if num_layers is not None and num_layers != self.cfg.num_hidden_layers:
+            assert 0 < num_layers < self.cfg.num_hidden_layers, f"invalid {num_layers=}"
+            with self.compile_lock:
+                if num_layers not in self.reduced_backends:
+                    llama = _truncated_llama(self.tfmr, num_layers)
+                    self.reduced_backends[num_layers] = T3HuggingfaceBackend(
+                        config=llama.config,
+                        llama=llama,
+                        speech_enc=self.speech_emb,
+                        speech_head=self.speech_head,
+                        alignment_stream_analyzer=None,
+                    )
+                return self.reduced_backends[num_layers]
+
+        with self.compile_lock:
+            if "patched_model" not in self._modules:
+                # In order to use the standard HF generate method, we need to extend some methods to inject our
+                # custom logic. Note the llama-specific logic. Other tfmr types can be added later.
+                self.patched_model = T3HuggingfaceBackend(
+                    config=self.cfg,
+                    llama=self.tfmr,
+                    speech_enc=self.speech_emb,
+                    speech_head=self.speech_head,
+                    alignment_stream_analyzer=None,
+                )
+            return self.patched_model
+
+    def compile_backend(self, **compile_kwargs) -> T3HuggingfaceBackend:
+        """
+        Wrap the backend with `torch.compile`, once. Compilation happens lazily on the first forward passes, so
+        call this at startup and run a warm-up generation to pay for it before serving requests.
+
+        Args:
+            compile_kwargs: passed to `torch.compile`, defaults to `dynamic=True` since the KV length changes
+                every step.
+        """
+        backend = self.get_backend()
+        with self.compile_lock:
+            if not self.compiled:
+                compile_kwargs.setdefault("dynamic", True)
+                self.patched_model = torch.compile(backend, **compile_kwargs)
+                self.compiled = True
+            return self.patched_model
+
+    def set_dtype(self, dtype):
+        """
+        Run T3 in `dtype`, eg. `torch.bfloat16`. `speech_head` stays in float32: the logits keep full precision for
+        CFG and sampling, at little cost next to the backbone.
+        """
+        self.to(dtype=dtype)
+        self.speech_head.float()
+        with self.prefix_lock:
+            self.prefix_cache.clear()
+
+    def quantize_dynamic(self):
+        """
+        Replace the linear layers of the Llama backbone with int8 dynamically quantized ones, for CPU inference.
+        The embeddings and heads are left in float. Call it before `compile_backend`.
+        """
+        assert self.device.type == "cpu", "dynamic quantization only runs on CPU"
+        torch.ao.quantization.quantize_dynamic(self.tfmr, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        with self.prefix_lock:
+            self.prefix_cache.clear()
+
+    def prepare_conditioning(self, t3_cond: Union[T3Cond, List[T3Cond]]):
         """
         Token cond data needs to be embedded, so that needs to be here instead of in `T3CondEnc`.
+        A list of conds (eg. one voice per row of a batch) is embedded one by one, since their prompts can have
+        different lengths, and concatenated along the batch axis.
         """
+        if isinstance(t3_cond, (list, tuple)):
+            return torch.cat([self.prepare_conditioning(c) for c in t3_cond])
         if t3_cond.cond_prompt_speech_tokens is not None and t3_cond.cond_prompt_speech_emb is None:
             t3_cond.cond_prompt_speech_emb = self.speech_emb(t3_cond.cond_prompt_speech_tokens) + \
                 self.speech_pos_emb(t3_cond.cond_prompt_speech_tokens)
         return self.cond_enc(t3_cond)  # (B, len_cond, dim)
 
-    def prepare_input_embeds(
+    def prepare_text_speech_embeds(
         self,
         *,
-        t3_cond: T3Cond,
         text_tokens: torch.LongTensor,
         speech_tokens: torch.LongTensor,
         cfg_weight: float = 0.0,
     ):
-        # prepare input embeddings (skip backbone tranformer embeddings)
-        cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
+        "Embed the text and speech tokens, ie. the input embeds after the conditioning prefix. (B, length, dim)"
         text_emb = self.text_emb(text_tokens)  # (B, len_text, dim)
         if cfg_weight > 0.0:
-            text_emb[1].zero_()  # CFG uncond
+            text_emb[text_emb.size(0) // 2:].zero_()  # CFG uncond
 
         speech_emb = self.speech_emb(speech_tokens)  # (B, len_speech, dim)
         if self.hp.input_pos_emb == "learned":
             text_emb = text_emb + self.text_pos_emb(text_tokens)
             speech_emb = speech_emb + self.speech_pos_emb(speech_tokens)
+        return torch.cat((text_emb, speech_emb), dim=1)
+
+    def prepare_input_embeds(
+        self,
+        *,
+        t3_cond: T3Cond,
+        text_tokens: torch.LongTensor,
+        speech_tokens: torch.LongTensor,
+        cfg_weight: float = 0.0,
+    ):
+        # prepare input embeddings (skip backbone tranformer embeddings)
+        cond_emb = self.prepare_conditioning(t3_cond)  # (B, len_cond, dim)
+        text_speech_emb = self.prepare_text_speech_embeds(
+            text_tokens=text_tokens,
+            speech_tokens=speech_tokens,
+            cfg_weight=cfg_weight,
+        )  # (B, len_text + len_speech, dim)
         len_cond = cond_emb.size(1)
 
-        if cond_emb.size(0) != text_emb.size(0):
-             cond_emb = cond_emb.expand(text_emb.size(0), -1, -1)
+        B = text_speech_emb.size(0)
+        if cond_emb.size(0) == 1:
+            cond_emb = cond_emb.expand(B, -1, -1)
+        elif cond_emb.size(0) != B:
+            cond_emb = cond_emb.repeat(B // cond_emb.size(0), 1, 1)  # CFG uncond rows
 
         # concat
-        embeds = torch.stack([
-            torch.cat((ce, te, se))
-            for ce, te, se in zip(cond_emb, text_emb, speech_emb)
-        ])  # (B, length, dim)
+        embeds = torch.cat((cond_emb, text_speech_emb), dim=1)  # (B, length, dim)
         return embeds, len_cond
 
     def forward(
@@ -200,12 +316,173 @@ class T3(nn.Module):
 
         return loss_text, loss_speech
 
+    @staticmethod
+    def cond_key(t3_cond: T3Cond) -> str:
+        "Content hash of a cond, the key of its conditioning prefix in `prefix_cache`."
+        h = hashlib.sha1()
+        fields = ["speaker_emb", "clap_emb", "cond_prompt_speech_tokens", "emotion_adv"]
+        if t3_cond.cond_prompt_speech_tokens is None:
+            fields.append("cond_prompt_speech_emb")
+        for name in fields:
+            v = getattr(t3_cond, name)
+            if torch.is_tensor(v):
+                h.update(f"{name}{tuple(v.shape)}".encode())
+                h.update(v.detach().double().cpu().numpy().tobytes())
+            else:
+                h.update(f"{name}={v!r}".encode())
+        return h.hexdigest()
+
+    def cond_prefix(self, t3_cond: T3Cond, key=None) -> List[Tuple[Tensor, Tensor]]:
+        """
+        The per-layer (1, H, len_cond, D) keys / values of the conditioning prefix (speaker projection, Perceiver
+        tokens, emotion token) of a voice. The prefix is the same for every utterance with this cond, so it's
+        computed once and kept in an LRU of `prefix_cache_size` entries.
+        """
+        key = key or self.cond_key(t3_cond)
+        with self.prefix_lock:
+            if key in self.prefix_cache:
+                self.prefix_cache.move_to_end(key)
+                return self.prefix_cache[key]
+
+        cond_emb = self.prepare_conditioning(t3_cond)  # (1, len_cond, dim)
+        cache = StaticKVCache.from_config(self.cfg, 1, cond_emb.size(1), dtype=cond_emb.dtype, device=cond_emb.device)
+        self.tfmr(inputs_embeds=cond_emb, past_key_values=cache, use_cache=True, return_dict=True)
+        prefix = list(zip(cache.key_cache, cache.value_cache))
+        if self.prefix_cache_size <= 0:
+            return prefix
+
+        with self.prefix_lock:
+            self.prefix_cache[key] = prefix
+            while len(self.prefix_cache) > self.prefix_cache_size:
+                self.prefix_cache.popitem(last=False)
+        return prefix
+
+    def _cond_prefix_batch(self, t3_cond: Union[T3Cond, List[T3Cond]]):
+        """
+        Stack the prefixes of a list of conds, or None if they can't share a batch (different lengths). Each distinct
+        voice is run once: CFG rows and repeated voices get the same prefix in `StaticKVCache.set_prefix`.
+        """
+        conds = list(t3_cond) if isinstance(t3_cond, (list, tuple)) else [t3_cond]
+        keys = [self.cond_key(c) for c in conds]
+        unique = {}
+        for key, c in zip(keys, conds):
+            if key not in unique:
+                unique[key] = self.cond_prefix(c, key=key)
+        prefixes = [unique[key] for key in keys]
+        if len(unique) == 1:
+            return prefixes[0]
+        if len({p[0][0].size(2) for p in prefixes}) != 1:
+            return None
+        return [
+            (torch.cat([p[i][0] for p in prefixes]), torch.cat([p[i][1] for p in prefixes]))
+            for i in range(len(prefixes[0]))
+        ]
+
+    def prefill(
+        self,
+        *,
+        t3_cond: Union[T3Cond, List[T3Cond]],
+        text_tokens: Tensor,
+        text_token_lens: Optional[Tensor]=None,
+        initial_speech_tokens: Optional[Tensor]=None,
+        max_new_tokens=0,
+        cfg_weight=0,
+        num_layers=None,
+    ):
+        """
+        Run the prompt through the backbone, into a `StaticKVCache` with room for `max_new_tokens` more.
+        `num_layers` selects a reduced depth backend, see `get_backend`.
+
+        The KV of the conditioning prefix comes from `cond_prefix` when possible: it's computed once per voice
+        (or cached), not for every row, and with CFG the unconditional rows share it with the conditional ones.
+        Only the text and speech tokens are processed per row. Right-padded text rows keep their padding in place:
+        it's masked out, and the position ids skip it, so every row sees the same relative positions as it would on
+        its own.
+
+        Returns:
+            an AttrDict with
+            - logits: (B, V) next token logits
+            - past: the KV cache
+            - attention_mask: None without padding, otherwise (B, length + max_new_tokens), `length` being filled
+            - position_ids: None without padding, otherwise the (B, 1) positions of the next tokens
+        """
+        B, len_text = text_tokens.shape
+        device = text_tokens.device
+
+        # Default initial speech to a single start-of-speech token
+        if initial_speech_tokens is None:
+            initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
+
+        prefix = self._cond_prefix_batch(t3_cond)
+        if prefix is not None:
+            len_cond = prefix[0][0].size(2)
+            embeds = self.prepare_text_speech_embeds(
+                text_tokens=text_tokens,
+                speech_tokens=initial_speech_tokens,
+                cfg_weight=cfg_weight,
+            )
+        else:
+            embeds, len_cond = self.prepare_input_embeds(
+                t3_cond=t3_cond,
+                text_tokens=text_tokens,
+                speech_tokens=initial_speech_tokens,
+                cfg_weight=cfg_weight,
+            )
+
+        # With CFG, an extra BOS is appended to the initial speech token(s)
+        if cfg_weight > 0:
+            bos_token = torch.full((1, 1), self.hp.start_speech_token, dtype=torch.long, device=device)
+            bos_embed = self.speech_emb(bos_token) + self.speech_pos_emb.get_fixed_embedding(0)
+            embeds = torch.cat([embeds, bos_embed.expand(B, -1, -1)], dim=1)
+
+        # The first layers of a reduced depth backend have the same KV as in the full model
+        backend = self.get_backend(num_layers)
+        length = embeds.size(1) + (len_cond if prefix is not None else 0)
+        past = StaticKVCache.from_config(backend.config, B, length + max_new_tokens, dtype=embeds.dtype, device=device)
+        if prefix is not None:
+            past.set_prefix(prefix[:backend.config.num_hidden_layers])
+
+        attention_mask = position_ids = None
+        if text_token_lens is not None and (text_token_lens != len_text).any():
+            # Mask the padding between each row's text and its speech, and skip it in the positions
+            text_token_lens = text_token_lens.to(device).view(B, 1)
+            offsets = torch.arange(length + max_new_tokens, device=device).view(1, -1) - len_cond
+            attention_mask = ((offsets < text_token_lens) | (offsets >= len_text)).long()
+            position_ids = attention_mask[:, :length].cumsum(dim=1) - 1
+
+        output = backend(
+            inputs_embeds=embeds,
+            attention_mask=attention_mask[:, :length] if attention_mask is not None else None,
+            position_ids=position_ids[:, length - embeds.size(1):] if position_ids is not None else None,
+            past_key_values=past,
+            use_cache=True,
+            return_dict=True,
+        )
+        return AttrDict(
+            logits=output.logits[:, -1, :],
+            past=past,
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, -1:] + 1 if position_ids is not None else None,
+        )
+
     @torch.inference_mode()
-    def inference(
+    def inference(self, **kwargs):
+        """
+        Decode the speech tokens of the whole utterance(s), see `inference_stream` for the arguments.
+
+        Returns:
+            (N, T) predicted speech tokens, each row stops independently and is filled with `stop_speech_token` after
+            its own EOS.
+        """
+        return torch.cat(list(self.inference_stream(**kwargs)), dim=1)
+
+    @torch.inference_mode()
+    def inference_stream(
         self,
         *,
-        t3_cond: T3Cond,
+        t3_cond: Union[T3Cond, List[T3Cond]],
         text_tokens: Tensor,
+        text_token_lens: Optional[Tensor]=None,
         initial_speech_tokens: Optional[Tensor]=None,
 
         # misc conditioning
@@ -222,45 +499,32 @@ class T3(nn.Module):
         length_penalty=1.0,
         repetition_penalty=1.2,
         cfg_weight=0,
+        speculative_tokens=0,
+        num_layers=None,
     ):
         """
         Args:
-            text_tokens: a 1D (unbatched) or 2D (batched) tensor.
+            t3_cond: a single cond shared by all rows, or a list with one cond per utterance.
+            text_tokens: a 1D (unbatched) or 2D (batched) tensor. With CFG, the N utterances are followed by N
+                copies of themselves for the unconditional rows, ie. (2N, T).
+            text_token_lens: (B,) lengths of right-padded `text_tokens`. Defaults to no padding.
+            speculative_tokens: if > 0, up to this many draft tokens are proposed by n-gram lookup and verified in
+                a single forward pass, see `_speculative_decode`. Single utterances only.
+            num_layers: decode with only the first `num_layers` layers of the backbone, see `get_backend`.
+
+        Yields:
+            (N, 1) speech tokens as soon as they are sampled, up to and including the step where the last row emits
+            `stop_speech_token`. Rows that are done keep emitting `stop_speech_token`.
         """
         # Validate / sanitize inputs
         assert prepend_prompt_speech_tokens is None, "not implemented"
         _ensure_BOT_EOT(text_tokens, self.hp)
         text_tokens = torch.atleast_2d(text_tokens).to(dtype=torch.long, device=self.device)
-
-        # Default initial speech to a single start-of-speech token
-        if initial_speech_tokens is None:
-            initial_speech_tokens = self.hp.start_speech_token * torch.ones_like(text_tokens[:, :1])
-
-        # Prepare custom input embeds
-        embeds, len_cond = self.prepare_input_embeds(
-            t3_cond=t3_cond,
-            text_tokens=text_tokens,
-            speech_tokens=initial_speech_tokens,
-            cfg_weight=cfg_weight,
-        )
-
-        # In order to use the standard HF generate method, we need to extend some methods to inject our custom logic
-        # Note the llama-specific logic. Other tfmr types can be added later.
-
-        self.compiled = False
-
-        # TODO? synchronize the expensive compile function
-        # with self.compile_lock:
-        if not self.compiled:
-            patched_model = T3HuggingfaceBackend(
-                config=self.cfg,
-                llama=self.tfmr,
-                speech_enc=self.speech_emb,
-                speech_head=self.speech_head,
-                alignment_stream_analyzer=None,
-            )
-            self.patched_model = patched_model
-            self.compiled = True
+        max_new_tokens = max_new_tokens or self.hp.max_speech_tokens
+        B = text_tokens.size(0)
+        N = B // 2 if cfg_weight > 0.0 else B  # number of utterances
+        device = text_tokens.device
+        assert speculative_tokens == 0 or N == 1, "speculative decoding only supports a single utterance"
 
         # # Run normal generate method, which calls our custom extended methods
         # return self.patched_model.generate(
@@ -279,72 +543,66 @@ class T3(nn.Module):
         #     # cache_implementation=None if not self.compiled else "static",
         # )
 
-        device = embeds.device
-
-        bos_token = torch.tensor([[self.hp.start_speech_token]], dtype=torch.long, device=device)
-        bos_embed = self.speech_emb(bos_token)  # shape: (B, 1, embed_dim)
-        bos_embed = bos_embed + self.speech_pos_emb.get_fixed_embedding(0)
-
-        # batch_size=2 for CFG
-        bos_embed = torch.cat([bos_embed, bos_embed])
-
-        # Combine condition and BOS token for the initial input if cfg_weight > 0
-        if cfg_weight > 0:
-            inputs_embeds = torch.cat([embeds, bos_embed], dim=1)
-        else:
-            inputs_embeds = embeds
-
-        # Track generated token ids; start with the BOS token.
-        generated_ids = bos_token.clone()
-        predicted = []  # To store the predicted tokens
-
-        # Instantiate the logits processors.
-        min_p_warper = MinPLogitsWarper(min_p=min_p)
-        top_p_warper = TopPLogitsWarper(top_p=top_p)
-        repetition_penalty_processor = RepetitionPenaltyLogitsProcessor(penalty=float(repetition_penalty))
-
-        # ---- Initial Forward Pass (no kv_cache yet) ----
-        output = self.patched_model(
-            inputs_embeds=inputs_embeds,
-            past_key_values=None,
-            use_cache=True,
-            output_attentions=True,
-            output_hidden_states=True,
-            return_dict=True,
+        # ---- Initial Forward Pass, into a kv_cache preallocated for the whole generation ----
+        output = self.prefill(
+            t3_cond=t3_cond,
+            text_tokens=text_tokens,
+            text_token_lens=text_token_lens,
+            initial_speech_tokens=initial_speech_tokens,
+            max_new_tokens=max_new_tokens,
+            cfg_weight=cfg_weight,
+            num_layers=num_layers,
         )
-        # Initialize kv_cache with the full context.
-        past = output.past_key_values
+        past, attention_mask, position_ids = output.past, output.attention_mask, output.position_ids
+        logits = output.logits
+        patched_model = self.get_backend(num_layers)
+
+        finished = torch.zeros(N, dtype=torch.bool, device=device)
+
+        # The sampler keeps track of the generated tokens, starting with the BOS token.
+        sampler = T3Sampler(
+            N,
+            logits.size(-1),
+            temperature=temperature,
+            min_p=min_p,
+            top_p=top_p,
+            repetition_penalty=repetition_penalty,
+            device=device,
+        )
+        sampler.observe(torch.full((N, 1), self.hp.start_speech_token, dtype=torch.long, device=device))
+
+        if speculative_tokens > 0:
+            yield from self._speculative_decode(
+                t3_cond=t3_cond,
+                logits=logits,
+                past=past,
+                sampler=sampler,
+                max_new_tokens=max_new_tokens,
+                cfg_weight=cfg_weight,
+                n_draft=speculative_tokens,
+                patched_model=patched_model,
+            )
+            return
 
         # ---- Generation Loop using kv_cache ----
         for i in tqdm(range(max_new_tokens), desc="Sampling", dynamic_ncols=True):
-            logits = output.logits[:, -1, :]
-
             # CFG
             if cfg_weight > 0.0:
-                logits_cond = logits[0:1]
-                logits_uncond = logits[1:2]
+                logits_cond = logits[:N]
+                logits_uncond = logits[N:]
                 logits = logits_cond + cfg_weight * (logits_cond - logits_uncond)
 
-            logits = logits.squeeze(1)
+            # Temperature, repetition penalty, min-p / top-p filtering and sampling
+            next_token = sampler(logits)  # shape: (N, 1)
 
-            # Apply temperature scaling.
-            if temperature != 1.0:
-                logits = logits / temperature
+            # Rows that are already done keep emitting EOS
+            next_token = next_token.masked_fill(finished.view(N, 1), self.hp.stop_speech_token)
 
-            # Apply repetition penalty and top‑p filtering.
-            logits = repetition_penalty_processor(generated_ids, logits)
-            logits = min_p_warper(None, logits)
-            logits = top_p_warper(None, logits)
-
-            # Convert logits to probabilities and sample the next token.
-            probs = torch.softmax(logits, dim=-1)
-            next_token = torch.multinomial(probs, num_samples=1)  # shape: (B, 1)
-
-            predicted.append(next_token)
-            generated_ids = torch.cat([generated_ids, next_token], dim=1)
+            yield next_token
 
             # Check for EOS token.
-            if next_token.view(-1) == self.hp.stop_speech_token:
+            finished |= next_token.view(-1) == self.hp.stop_speech_token
+            if finished.all():
                 break
 
             # Get embedding for the new token.
@@ -355,17 +613,76 @@ class T3(nn.Module):
             if cfg_weight > 0.0:
                 next_token_embed = torch.cat([next_token_embed, next_token_embed])
 
-            # Forward pass with only the new token and the cached past.
-            output = self.patched_model(
+            # Forward pass with only the new token, the kv_cache is updated in place.
+            mask_len = past.get_seq_length() + 1
+            output = patched_model(
                 inputs_embeds=next_token_embed,
+                attention_mask=attention_mask[:, :mask_len] if attention_mask is not None else None,
+                position_ids=position_ids,
                 past_key_values=past,
-                output_attentions=True,
-                output_hidden_states=True,
                 return_dict=True,
             )
-            # Update the kv_cache.
-            past = output.past_key_values
+            logits = output.logits[:, -1, :]
+            if position_ids is not None:
+                position_ids = position_ids + 1
 
-        # Concatenate all predicted tokens along the sequence dimension.
-        predicted_tokens = torch.cat(predicted, dim=1)  # shape: (B, num_tokens)
-        return predicted_tokens
+    def _speculative_decode(
+        self, *, t3_cond, logits, past, sampler, max_new_tokens, cfg_weight, n_draft, patched_model,
+    ):
+        """
+        Decoding loop of `inference_stream` with speculative decoding, for a single utterance after `prefill`.
+
+        Each step feeds the last sampled token followed by up to `n_draft` tokens proposed by a `NgramDrafter`,
+        and gets the logits of all of them in one forward pass. The drafts are then verified in order with
+        `accept_draft`, so the tokens follow the same distribution as plain sampling. The first rejected draft is
+        replaced by a token sampled from the residual distribution, and its KV (and that of the following drafts)
+        is dropped from the cache. With all drafts accepted, the next token comes from the last logits for free.
+        """
+        cond = t3_cond[0] if isinstance(t3_cond, (list, tuple)) else t3_cond
+        prompt_tokens = cond.cond_prompt_speech_tokens
+        history = prompt_tokens[0].tolist() if prompt_tokens is not None else []
+        drafter = NgramDrafter(history)
+        device = logits.device
+
+        def probs_at(j):
+            step_logits = logits[:, j]
+            if cfg_weight > 0.0:
+                step_logits = step_logits[:1] + cfg_weight * (step_logits[:1] - step_logits[1:])
+            return torch.softmax(sampler.warp(step_logits), dim=-1)[0]
+
+        logits = logits.unsqueeze(1)  # (B, 1, V)
+        token = int(torch.multinomial(probs_at(0), num_samples=1))
+        n_generated = 0
+        while True:
+            # `token` was sampled but isn't in the cache yet
+            sampler.observe(torch.tensor([[token]], device=device))
+            drafter.append(token)
+            n_generated += 1
+            yield torch.tensor([[token]], device=device)
+            if token == self.hp.stop_speech_token or n_generated >= max_new_tokens:
+                return
+
+            draft = drafter.propose(min(n_draft, max_new_tokens - n_generated))
+            tokens = torch.tensor([[token] + draft], device=device)
+            embeds = self.speech_emb(tokens) + self.speech_pos_emb.get_fixed_embedding(
+                torch.arange(n_generated, n_generated + tokens.size(1), device=device)
+            )
+            if cfg_weight > 0.0:
+                embeds = torch.cat([embeds, embeds])
+
+            start = past.get_seq_length()
+            logits = patched_model(inputs_embeds=embeds, past_key_values=past, return_dict=True).logits
+
+            for j, draft_token in enumerate(draft):
+                accepted, token = accept_draft(probs_at(j), draft_token)
+                if not accepted:
+                    past.crop(start + j + 1)
+                    break
+                sampler.observe(torch.tensor([[token]], device=device))
+                drafter.append(token)
+                n_generated += 1
+                yield torch.tensor([[token]], device=device)
+                if token == self.hp.stop_speech_token or n_generated >= max_new_tokens:
+                    return
+            else:
+                token = int(torch.multinomial(probs_at(len(draft)), num_samples=1))
@@ -3,6 +3,9 @@ from functools import lru_cache
 from scipy import signal
 import numpy as np
 import librosa
+import torch
+import torch.nn.functional as F
+import torchaudio
 
 
 @lru_cache()
@@ -76,3 +79,102 @@ def _normalize(s, hp, headroom_db=15):
     min_level_db = 20 * np.log10(hp.stft_magnitude_min)
     s = (s - min_level_db) / (-min_level_db + headroom_db)
     return s
+
+
+# Torch versions of the above for batches of wavs of different lengths, given as a zero-padded (B, T) tensor and
+# their lengths. They stay on the device of the wavs.
+
+def _length_mask(lens, max_len):
+    return torch.arange(max_len, device=lens.device) < lens[:, None]
+
+
+def batch_resample(wavs, wav_lens, orig_sr, target_sr):
+    """
+    `librosa.resample(res_type="kaiser_fast")` with the matching torchaudio windowed sinc filter. The filter pads the
+    wavs with zeros, so the padding of the batch doesn't change the samples of the shorter wavs.
+    """
+    wavs = torchaudio.functional.resample(
+        wavs, orig_sr, target_sr,
+        lowpass_filter_width=16,
+        rolloff=0.85,
+        resampling_method="sinc_interp_kaiser",
+        beta=8.555822108602637,
+    )
+    wav_lens = (wav_lens * target_sr + orig_sr - 1) // orig_sr
+    max_len = int(wav_lens.max())
+    wavs = wavs[:, :max_len] * _length_mask(wav_lens, max_len)
+    return wavs, wav_lens
+
+
+def batch_trim(wavs, wav_lens, top_db=60, frame_length=2048, hop_length=512):
+    """
+    `librosa.effects.trim`: cut the leading and trailing frames whose RMS is more than `top_db` below the loudest
+    frame of the wav.
+    """
+    # librosa.feature.rms, centered frames padded with zeros
+    padded = F.pad(wavs, (frame_length // 2, frame_length // 2))
+    power = padded.unfold(1, frame_length, hop_length).square().mean(dim=-1)  # (B, n_frames)
+    n_frames = 1 + wav_lens // hop_length
+    power = power.masked_fill(~_length_mask(n_frames, power.size(1)), 0)
+
+    # librosa.amplitude_to_db(rms, ref=np.max) > -top_db
+    db = 10 * torch.log10(power.clamp(min=1e-10))
+    ref_db = 10 * torch.log10(power.amax(dim=1, keepdim=True).clamp(min=1e-10))
+    non_silent = (db - ref_db > -top_db) & _length_mask(n_frames, power.size(1))
+
+    any_non_silent = non_silent.any(dim=1)
+    first = non_silent.int().argmax(dim=1)
+    last = power.size(1) - 1 - non_silent.flip(1).int().argmax(dim=1)
+    start = torch.where(any_non_silent, first * hop_length, 0)
+    end = torch.where(any_non_silent, torch.minimum(wav_lens, (last + 1) * hop_length), 0)
+
+    # Shift each wav to its start
+    wav_lens = end - start
+    max_len = int(wav_lens.max())
+    idx = (start[:, None] + torch.arange(max_len, device=wavs.device)).clamp(max=wavs.size(1) - 1)
+    wavs = wavs.gather(1, idx) * _length_mask(wav_lens, max_len)
+    return wavs, wav_lens
+
+
+def _batch_preemphasis(wavs, wav_lens, hp):
+    assert hp.preemphasis != 0
+    wavs = torch.cat([wavs[:, :1], wavs[:, 1:] - hp.preemphasis * wavs[:, :-1]], dim=1)
+    return wavs.clamp(-1, 1) * _length_mask(wav_lens, wavs.size(1))
+
+
+def batch_melspectrogram(wavs, wav_lens, hp, pad=True):
+    """
+    `melspectrogram` of each wav of the batch, with one STFT and one mel matmul.
+
+    :return: (B, M, T) mels, zero-padded, and their lengths
+    """
+    if hp.preemphasis > 0:
+        wavs = _batch_preemphasis(wavs, wav_lens, hp)
+
+    # Centered STFT: reflect-pad each wav at its own end, as if it was alone
+    if pad:
+        n_pad = hp.n_fft // 2
+        offsets = torch.arange(n_pad, device=wavs.device)
+        padded = F.pad(wavs, (n_pad, n_pad))
+        padded[:, :n_pad] = wavs[:, 1:n_pad + 1].flip(1)
+        right = wavs.gather(1, wav_lens[:, None] - 2 - offsets)
+        padded.scatter_(1, wav_lens[:, None] + n_pad + offsets, right)
+        wavs = padded
+    mel_lens = 1 + (wav_lens if pad else wav_lens - hp.n_fft) // hp.hop_size
+
+    window = torch.hann_window(hp.win_size, device=wavs.device)
+    spec_complex = torch.stft(
+        wavs, hp.n_fft, hp.hop_size, hp.win_size, window=window, center=False, return_complex=True
+    )
+    spec_magnitudes = spec_complex.abs()
+    if hp.mel_power != 1.0:
+        spec_magnitudes = spec_magnitudes ** hp.mel_power
+
+    mel = torch.from_numpy(mel_basis(hp)).to(wavs.device) @ spec_magnitudes
+    if hp.mel_type == "db":
+        mel = 20 * torch.log10(mel.clamp(min=hp.stft_magnitude_min))
+    if hp.normalized_mels:
+        mel = _normalize(mel, hp)
+
+    mel = mel * _length_mask(mel_lens, mel.size(2))[:, None]
+    return mel, mel_lens
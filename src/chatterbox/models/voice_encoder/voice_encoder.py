@@ -4,13 +4,12 @@ from typing import List, Union, Optional
 
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
-import librosa
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
 
 from .config import VoiceEncConfig
-from .melspec import melspectrogram
+from .melspec import batch_resample, batch_trim, batch_melspectrogram
 
 
 def pack(arrays, seq_len: int=None, pad_value=0):
@@ -175,28 +174,27 @@ class VoiceEncoder(nn.Module):
         # Possibly pad the mels to reach the target lengths
         len_diff = max(target_lens) - mels.size(1)
         if len_diff > 0:
-            pad = torch.full((mels.size(0), len_diff, self.hp.num_mels), 0, dtype=torch.float32)
-            mels = torch.cat((mels, pad.to(mels.device)), dim=1)
+            mels = F.pad(mels, (0, 0, 0, len_diff))
 
-        # Group all partials together so that we can batch them easily
-        partials = [
-            mel[i * frame_step: i * frame_step + self.hp.ve_partial_frames]
-            for mel, n_partial in zip(mels, n_partials) for i in range(n_partial)
-        ]
-        assert all(partials[0].shape == partial.shape for partial in partials)
-        partials = torch.stack(partials)
+        # Group all partials together so that we can batch them easily: all the windows of every mel as a (B, N, M, P)
+        # view (the torch counterpart of stride_as_partials), of which we keep the first n_partials of each mel
+        n_partials = torch.tensor(n_partials, device=mels.device)
+        windows = mels.unfold(1, self.hp.ve_partial_frames, frame_step)[:, :int(n_partials.max())]
+        keep = torch.arange(windows.size(1), device=mels.device) < n_partials[:, None]
+        partials = windows[keep].transpose(1, 2)  # (sum(n_partials), P, M)
 
         # Forward the partials
         n_chunks = int(np.ceil(len(partials) / (batch_size or len(partials))))
-        partial_embeds = torch.cat([self(batch) for batch in partials.chunk(n_chunks)], dim=0).cpu()
+        partial_embeds = torch.cat([self(batch) for batch in partials.chunk(n_chunks)], dim=0)
 
-        # Reduce the partial embeds into full embeds and L2-normalize them
-        slices = np.concatenate(([0], np.cumsum(n_partials)))
-        raw_embeds = [torch.mean(partial_embeds[start:end], dim=0) for start, end in zip(slices[:-1], slices[1:])]
-        raw_embeds = torch.stack(raw_embeds)
+        # Reduce the partial embeds into full embeds (segment mean) and L2-normalize them
+        utt_idx = torch.repeat_interleave(torch.arange(len(n_partials), device=mels.device), n_partials)
+        raw_embeds = partial_embeds.new_zeros(len(n_partials), partial_embeds.size(1))
+        raw_embeds.index_add_(0, utt_idx, partial_embeds)
+        raw_embeds = raw_embeds / n_partials[:, None]
         embeds = raw_embeds / torch.linalg.norm(raw_embeds, dim=1, keepdim=True)
 
-        return embeds
+        return embeds.cpu()
 
     @staticmethod
     def utt_to_spk_embed(utt_embeds: np.ndarray):
@@ -245,7 +243,7 @@ class VoiceEncoder(nn.Module):
 
     def embeds_from_wavs(
         self,
-        wavs: List[np.ndarray],
+        wavs: List[Union[np.ndarray, Tensor]],
         sample_rate,
         as_spk=False,
         batch_size=32,
@@ -253,22 +251,26 @@ class VoiceEncoder(nn.Module):
         **kwargs
     ):
         """
-        Wrapper around embeds_from_mels
+        Wrapper around inference() for raw wavs. The whole batch is resampled, trimmed and turned into mels with
+        tensor ops on the device of the model (see the batch_* functions of melspec.py), with the same features as
+        melspectrogram() on the librosa-resampled and trimmed wavs.
 
         :param trim_top_db: this argument was only added for the sake of compatibility with metavoice's implementation
         """
-        if sample_rate != self.hp.sample_rate:
-            wavs = [
-                librosa.resample(wav, orig_sr=sample_rate, target_sr=self.hp.sample_rate, res_type="kaiser_fast")
-                for wav in wavs
-            ]
-
-        if trim_top_db:
-            wavs = [librosa.effects.trim(wav, top_db=trim_top_db)[0] for wav in wavs]
-
         if "rate" not in kwargs:
             kwargs["rate"] = 1.3  # Resemble's default value.
 
-        mels = [melspectrogram(w, self.hp).T for w in wavs]
+        with torch.inference_mode():
+            wav_lens = torch.tensor([len(wav) for wav in wavs], device=self.device)
+            wavs = pack([torch.as_tensor(wav, dtype=torch.float32, device=self.device) for wav in wavs])
+
+            if sample_rate != self.hp.sample_rate:
+                wavs, wav_lens = batch_resample(wavs, wav_lens, sample_rate, self.hp.sample_rate)
 
-        return self.embeds_from_mels(mels, as_spk=as_spk, batch_size=batch_size, **kwargs)
+            if trim_top_db:
+                wavs, wav_lens = batch_trim(wavs, wav_lens, top_db=trim_top_db)
+
+            mels, mel_lens = batch_melspectrogram(wavs, wav_lens, self.hp)
+            utt_embeds = self.inference(mels.transpose(1, 2), mel_lens, batch_size=batch_size, **kwargs).numpy()
+
+        return self.utt_to_spk_embed(utt_embeds) if as_spk else utt_embeds
@@ -1,5 +1,10 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
+from typing import List, Union
 
 import librosa
 import torch
@@ -9,11 +14,12 @@ from huggingface_hub import hf_hub_download
 from safetensors.torch import load_file
 
 from .models.t3 import T3
-from .models.s3tokenizer import S3_SR, drop_invalid_tokens
+from .models.s3tokenizer import S3_SR, SPEECH_VOCAB_SIZE, drop_invalid_tokens
 from .models.s3gen import S3GEN_SR, S3Gen
 from .models.tokenizers import EnTokenizer
 from .models.voice_encoder import VoiceEncoder
 from .models.t3.modules.cond_enc import T3Cond
+from .models.t3.inference.scheduler import T3Scheduler
 
 
 REPO_ID = "ResembleAI/chatterbox"
@@ -91,7 +97,8 @@ class Conditionals:
     def save(self, fpath: Path):
         arg_dict = dict(
             t3=self.t3.__dict__,
-            gen=self.gen
+            # the flow's prompt cache is rebuilt on first use, with the weights it's used with
+            gen={k: v for k, v in self.gen.items() if k != "prompt_cache"},
         )
         torch.save(arg_dict, fpath)
 
@@ -103,6 +110,63 @@ class Conditionals:
         return cls(T3Cond(**kwargs['t3']), kwargs['gen'])
 
 
+class ConditionalsCache:
+    """
+    Content-addressed cache of `Conditionals`, so repeated reference voices skip all reference processing.
+    - entries are keyed by a hash of the reference wav bytes and the model revision
+    - an in-memory LRU holds up to `max_items` entries
+    - if `cache_dir` is given, entries are also persisted there with `Conditionals.save`
+    """
+
+    def __init__(self, cache_dir=None, max_items=32):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(wav_fpath, revision: str) -> str:
+        h = hashlib.sha256(revision.encode())
+        with open(wav_fpath, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _fpath(self, key):
+        return self.cache_dir / f"{key}.pt"
+
+    def get(self, key, device):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+        if self.cache_dir is None or not self._fpath(key).exists():
+            return None
+
+        map_location = "cpu" if device in ["cpu", "mps"] else device
+        conds = Conditionals.load(self._fpath(key), map_location=map_location).to(device)
+        self._remember(key, conds)
+        return conds
+
+    def put(self, key, conds: Conditionals):
+        if self.cache_dir is not None:
+            # write-then-rename so that concurrent readers never see a partial file
+            tmp_fpath = self._fpath(key).with_suffix(f".{os.getpid()}.tmp")
+            conds.save(tmp_fpath)
+            os.replace(tmp_fpath, self._fpath(key))
+        self._remember(key, conds)
+
+    def _remember(self, key, conds):
+        with self._lock:
+            self._items[key] = conds
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
 class ChatterboxTTS:
     ENC_COND_LEN = 6 * S3_SR
     DEC_COND_LEN = 10 * S3GEN_SR
@@ -115,6 +179,8 @@ class ChatterboxTTS:
         tokenizer: EnTokenizer,
         device: str,
         conds: Conditionals = None,
+        conds_cache: ConditionalsCache = None,
+        revision: str = "local",
     ):
         self.sr = S3GEN_SR  # sample rate of synthesized audio
         self.t3 = t3
@@ -123,10 +189,23 @@ class ChatterboxTTS:
         self.tokenizer = tokenizer
         self.device = device
         self.conds = conds
+        self.conds_cache = conds_cache if conds_cache is not None else ConditionalsCache()
+        self.revision = revision
+        self.t3_scheduler = None
         self.watermarker = perth.PerthImplicitWatermarker()
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxTTS':
+    def from_local(
+        cls, ckpt_dir, device, conds_cache_dir=None, compile_t3=False, quantize=False, dtype=torch.float32,
+    ) -> 'ChatterboxTTS':
+        """
+        Args:
+            compile_t3: compile the T3 backend with `torch.compile` and warm it up
+            quantize: apply int8 dynamic quantization to the linear layers of T3 and of the S3Gen flow, CPU only
+            dtype: run T3 and S3Gen in this dtype, eg. `torch.bfloat16` (see `T3.set_dtype` and `S3Gen.set_dtype`
+                for what stays in float32). The voice encoder and the reference processing always use float32.
+        """
+        assert not (quantize and dtype != torch.float32), "quantize only applies to float32 models"
         ckpt_dir = Path(ckpt_dir)
 
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
@@ -147,12 +226,23 @@ class ChatterboxTTS:
             t3_state = t3_state["model"][0]
         t3.load_state_dict(t3_state)
         t3.to(device).eval()
+        if dtype != torch.float32:
+            t3.set_dtype(dtype)
+        if quantize:
+            t3.quantize_dynamic()
+        if compile_t3:
+            t3.compile_backend()
 
         s3gen = S3Gen()
         s3gen.load_state_dict(
             load_file(ckpt_dir / "s3gen.safetensors"), strict=False
         )
         s3gen.to(device).eval()
+        s3gen.fuse_vocoder()
+        if dtype != torch.float32:
+            s3gen.set_dtype(dtype)
+        if quantize:
+            s3gen.quantize_dynamic()
 
         tokenizer = EnTokenizer(
             str(ckpt_dir / "tokenizer.json")
@@ -162,10 +252,21 @@ class ChatterboxTTS:
         if (builtin_voice := ckpt_dir / "conds.pt").exists():
             conds = Conditionals.load(builtin_voice, map_location=map_location).to(device)
 
-        return cls(t3, s3gen, ve, tokenizer, device, conds=conds)
+        # NOTE: HF hub snapshots live in a directory named after the commit hash
+        tts = cls(
+            t3, s3gen, ve, tokenizer, device,
+            conds=conds,
+            conds_cache=ConditionalsCache(conds_cache_dir),
+            revision=ckpt_dir.name,
+        )
+        if compile_t3 and conds is not None:
+            tts.warmup()
+        return tts
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxTTS':
+    def from_pretrained(
+        cls, device, conds_cache_dir=None, compile_t3=False, quantize=False, dtype=torch.float32,
+    ) -> 'ChatterboxTTS':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -177,9 +278,57 @@ class ChatterboxTTS:
         for fpath in ["ve.safetensors", "t3_cfg.safetensors", "s3gen.safetensors", "tokenizer.json", "conds.pt"]:
             local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
 
-        return cls.from_local(Path(local_path).parent, device)
+        return cls.from_local(
+            Path(local_path).parent,
+            device,
+            conds_cache_dir=conds_cache_dir,
+            compile_t3=compile_t3,
+            quantize=quantize,
+            dtype=dtype,
+        )
+
+    def warmup(self, text="Warming up.", max_new_tokens=8):
+        """
+        Run a short T3 decode with the built-in voice, with and without CFG, so that lazy work like
+        `torch.compile` (see `compile_t3`) happens before serving requests.
+        """
+        assert self.conds is not None, "Please `prepare_conditionals` first"
+        text_tokens = self._tokenize(text)
+        with torch.inference_mode():
+            for tokens, cfg_weight in [(text_tokens, 0.0), (torch.cat([text_tokens, text_tokens]), 0.5)]:
+                self.t3.inference(
+                    t3_cond=self.conds.t3,
+                    text_tokens=tokens,
+                    max_new_tokens=max_new_tokens,
+                    cfg_weight=cfg_weight,
+                )
+
+    def start_scheduler(self, max_batch_size=4) -> T3Scheduler:
+        """
+        Route T3 decoding through a continuous-batching `T3Scheduler`, so that concurrent `generate` /
+        `generate_batch` calls share decode steps. S3Gen still runs in the calling thread.
+        """
+        if self.t3_scheduler is None:
+            self.t3_scheduler = T3Scheduler(self.t3, max_batch_size=max_batch_size)
+        return self.t3_scheduler
 
     def prepare_conditionals(self, wav_fpath, exaggeration=0.5):
+        key = self.conds_cache.key(wav_fpath, self.revision)
+        if (conds := self.conds_cache.get(key, self.device)) is None:
+            conds = self._compute_conditionals(wav_fpath)
+            self.conds_cache.put(key, conds)
+
+        # Cached entries are shared, so only swap in a new T3Cond carrying this exaggeration
+        _cond: T3Cond = conds.t3
+        t3_cond = T3Cond(
+            speaker_emb=_cond.speaker_emb,
+            cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
+            emotion_adv=exaggeration * torch.ones(1, 1, 1),
+        ).to(device=self.device)
+        self.conds = Conditionals(t3_cond, conds.gen)
+        return self.conds
+
+    def _compute_conditionals(self, wav_fpath, exaggeration=0.5) -> Conditionals:
         ## Load reference wav
         s3gen_ref_wav, _sr = librosa.load(wav_fpath, sr=S3GEN_SR)
 
@@ -203,7 +352,7 @@ class ChatterboxTTS:
             cond_prompt_speech_tokens=t3_cond_prompt_tokens,
             emotion_adv=exaggeration * torch.ones(1, 1, 1),
         ).to(device=self.device)
-        self.conds = Conditionals(t3_cond, s3gen_ref_dict)
+        return Conditionals(t3_cond, s3gen_ref_dict)
 
     def generate(
         self,
@@ -215,36 +364,41 @@ class ChatterboxTTS:
         exaggeration=0.5,
         cfg_weight=0.5,
         temperature=0.8,
+        conds: Conditionals = None,
     ):
+        """
+        Args:
+            conds: precomputed conditionals (e.g. from `Conditionals.load`) to use instead of `self.conds`
+        """
         if audio_prompt_path:
             self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
-        else:
+        if conds is None:
             assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+            conds = self.conds
+
+        if self.t3_scheduler is not None:
+            return self.generate_batch(
+                [text],
+                conds=conds,
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
+                exaggeration=exaggeration,
+                cfg_weight=cfg_weight,
+                temperature=temperature,
+            )[0]
 
-        # Update exaggeration if needed
-        if exaggeration != self.conds.t3.emotion_adv[0, 0, 0]:
-            _cond: T3Cond = self.conds.t3
-            self.conds.t3 = T3Cond(
-                speaker_emb=_cond.speaker_emb,
-                cond_prompt_speech_tokens=_cond.cond_prompt_speech_tokens,
-                emotion_adv=exaggeration * torch.ones(1, 1, 1),
-            ).to(device=self.device)
+        self._update_exaggeration(conds, exaggeration)
 
         # Norm and tokenize text
-        text = punc_norm(text)
-        text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
+        text_tokens = self._tokenize(text)
 
         if cfg_weight > 0.0:
             text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
 
-        sot = self.t3.hp.start_text_token
-        eot = self.t3.hp.stop_text_token
-        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
-        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
-
         with torch.inference_mode():
             speech_tokens = self.t3.inference(
-                t3_cond=self.conds.t3,
+                t3_cond=conds.t3,
                 text_tokens=text_tokens,
                 max_new_tokens=1000,  # TODO: use the value in config
                 temperature=temperature,
@@ -254,19 +408,192 @@ class ChatterboxTTS:
                 top_p=top_p,
             )
             # Extract only the conditional batch.
-            speech_tokens = speech_tokens[0]
+            return self._speech_tokens_to_wav(speech_tokens[0], conds)
 
-            # TODO: output becomes 1D
-            speech_tokens = drop_invalid_tokens(speech_tokens)
-            
-            speech_tokens = speech_tokens[speech_tokens < 6561]
+    def generate_stream(
+        self,
+        text,
+        chunk_size=25,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        audio_prompt_path=None,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+        conds: Conditionals = None,
+    ):
+        """
+        Same as `generate`, but yields (1, num_samples) waveform chunks while the speech tokens are being decoded,
+        about every `chunk_size` speech tokens (25 tokens = 1s of audio).
 
-            speech_tokens = speech_tokens.to(self.device)
+        Args:
+            conds: precomputed conditionals (e.g. from `Conditionals.load`) to use instead of `self.conds`
+        """
+        if audio_prompt_path:
+            self.prepare_conditionals(audio_prompt_path, exaggeration=exaggeration)
+        if conds is None:
+            assert self.conds is not None, "Please `prepare_conditionals` first or specify `audio_prompt_path`"
+            conds = self.conds
+
+        text_tokens = self._tokenize(text)
+        t3_kwargs = dict(
+            max_new_tokens=1000,  # TODO: use the value in config
+            temperature=temperature,
+            cfg_weight=cfg_weight,
+            repetition_penalty=repetition_penalty,
+            min_p=min_p,
+            top_p=top_p,
+        )
+        if self.t3_scheduler is not None:
+            token_stream = self.t3_scheduler.submit_stream(
+                self._with_exaggeration(conds.t3, exaggeration), text_tokens, **t3_kwargs,
+            )
+        else:
+            self._update_exaggeration(conds, exaggeration)
+            if cfg_weight > 0.0:
+                text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
+            token_stream = self.t3.inference_stream(t3_cond=conds.t3, text_tokens=text_tokens, **t3_kwargs)
+
+        # The flow holds back `pre_lookahead_len` tokens until it's finalized
+        lookahead = self.s3gen.flow.pre_lookahead_len
+        speech_tokens = []
+        mel_offset, hift_streamer = 0, None
+        for token in token_stream:
+            token = token[0, 0].item()  # conditional row
+            if token >= SPEECH_VOCAB_SIZE:
+                continue
+            speech_tokens.append(token)
+            if len(speech_tokens) - lookahead - mel_offset // 2 >= chunk_size:
+                wav, mel_offset, hift_streamer = self.s3gen.inference_chunk(
+                    torch.tensor([speech_tokens], device=self.device),
+                    ref_dict=conds.gen,
+                    mel_offset=mel_offset,
+                    hift_streamer=hift_streamer,
+                )
+                if wav.shape[1] > 0:
+                    yield self._watermark(wav)
+
+        if speech_tokens:
+            wav, *_ = self.s3gen.inference_chunk(
+                torch.tensor([speech_tokens], device=self.device),
+                ref_dict=conds.gen,
+                mel_offset=mel_offset,
+                hift_streamer=hift_streamer,
+                finalize=True,
+            )
+            yield self._watermark(wav)
 
-            wav, _ = self.s3gen.inference(
-                speech_tokens=speech_tokens,
-                ref_dict=self.conds.gen,
+    def generate_batch(
+        self,
+        texts: List[str],
+        conds: Union[Conditionals, List[Conditionals]] = None,
+        repetition_penalty=1.2,
+        min_p=0.05,
+        top_p=1.0,
+        exaggeration=0.5,
+        cfg_weight=0.5,
+        temperature=0.8,
+    ) -> List[torch.Tensor]:
+        """
+        Synthesize several utterances with a single batched T3 decode, eg. all the lines of a script.
+
+        Args:
+            texts: the utterances
+            conds: one `Conditionals` shared by all utterances, or one per utterance. Defaults to `self.conds`.
+
+        Returns:
+            a list with one (1, num_samples) waveform per utterance
+        """
+        if conds is None:
+            assert self.conds is not None, "Please `prepare_conditionals` first or specify `conds`"
+            conds = self.conds
+        if isinstance(conds, Conditionals):
+            conds = [conds] * len(texts)
+        assert len(conds) == len(texts), "need one `Conditionals` per text"
+
+        if self.t3_scheduler is not None:
+            # Conds may be shared with other callers here, so don't update them in place
+            futures = [
+                self.t3_scheduler.submit(
+                    self._with_exaggeration(c.t3, exaggeration),
+                    self._tokenize(text),
+                    max_new_tokens=1000,  # TODO: use the value in config
+                    temperature=temperature,
+                    cfg_weight=cfg_weight,
+                    repetition_penalty=repetition_penalty,
+                    min_p=min_p,
+                    top_p=top_p,
+                )
+                for text, c in zip(texts, conds)
+            ]
+            with torch.inference_mode():
+                return [self._speech_tokens_to_wav(f.result()[0], c) for f, c in zip(futures, conds)]
+
+        for c in {id(c): c for c in conds}.values():
+            self._update_exaggeration(c, exaggeration)
+
+        # Right-pad the text tokens, T3 moves the padding out of the way
+        text_tokens = [self._tokenize(text)[0] for text in texts]
+        text_token_lens = torch.tensor([len(t) for t in text_tokens], device=self.device)
+        text_tokens = torch.nn.utils.rnn.pad_sequence(text_tokens, batch_first=True, padding_value=self.t3.hp.stop_text_token)
+
+        if cfg_weight > 0.0:
+            text_tokens = torch.cat([text_tokens, text_tokens], dim=0)  # Need two seqs for CFG
+            text_token_lens = torch.cat([text_token_lens, text_token_lens], dim=0)
+
+        with torch.inference_mode():
+            speech_tokens = self.t3.inference(
+                t3_cond=[c.t3 for c in conds],
+                text_tokens=text_tokens,
+                text_token_lens=text_token_lens,
+                max_new_tokens=1000,  # TODO: use the value in config
+                temperature=temperature,
+                cfg_weight=cfg_weight,
+                repetition_penalty=repetition_penalty,
+                min_p=min_p,
+                top_p=top_p,
             )
-            wav = wav.squeeze(0).detach().cpu().numpy()
-            watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
-        return torch.from_numpy(watermarked_wav).unsqueeze(0)
\ No newline at end of file
+            return [self._speech_tokens_to_wav(tokens, c) for tokens, c in zip(speech_tokens, conds)]
+
+    def _update_exaggeration(self, conds: Conditionals, exaggeration):
+        conds.t3 = self._with_exaggeration(conds.t3, exaggeration)
+
+    def _with_exaggeration(self, t3_cond: T3Cond, exaggeration) -> T3Cond:
+        if exaggeration == t3_cond.emotion_adv[0, 0, 0]:
+            return t3_cond
+        return T3Cond(
+            speaker_emb=t3_cond.speaker_emb,
+            cond_prompt_speech_tokens=t3_cond.cond_prompt_speech_tokens,
+            emotion_adv=exaggeration * torch.ones(1, 1, 1),
+        ).to(device=self.device)
+
+    def _tokenize(self, text) -> torch.Tensor:
+        "Normalize and tokenize a text, adding the start / stop text tokens. Returns (1, T) tokens."
+        text = punc_norm(text)
+        text_tokens = self.tokenizer.text_to_tokens(text).to(self.device)
+
+        sot = self.t3.hp.start_text_token
+        eot = self.t3.hp.stop_text_token
+        text_tokens = F.pad(text_tokens, (1, 0), value=sot)
+        text_tokens = F.pad(text_tokens, (0, 1), value=eot)
+        return text_tokens
+
+    def _speech_tokens_to_wav(self, speech_tokens, conds: Conditionals) -> torch.Tensor:
+        # TODO: output becomes 1D
+        speech_tokens = drop_invalid_tokens(speech_tokens)
+
+        speech_tokens = speech_tokens[speech_tokens < 6561]
+
+        speech_tokens = speech_tokens.to(self.device)
+
+        wav, _ = self.s3gen.inference(
+            speech_tokens=speech_tokens,
+            ref_dict=conds.gen,
+        )
+        return self._watermark(wav)
+
+    def _watermark(self, wav) -> torch.Tensor:
+        wav = wav.squeeze(0).detach().cpu().numpy()
+        watermarked_wav = self.watermarker.apply_watermark(wav, sample_rate=self.sr)
+        return torch.from_numpy(watermarked_wav).unsqueeze(0)
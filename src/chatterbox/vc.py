@@ -36,7 +36,8 @@ class ChatterboxVC:
             }
 
     @classmethod
-    def from_local(cls, ckpt_dir, device) -> 'ChatterboxVC':
+    def from_local(cls, ckpt_dir, device, quantize=False, dtype=torch.float32) -> 'ChatterboxVC':
+        assert not (quantize and dtype != torch.float32), "quantize only applies to float32 models"
         ckpt_dir = Path(ckpt_dir)
         
         # Always load to CPU first for non-CUDA devices to handle CUDA-saved models
@@ -55,11 +56,16 @@ class ChatterboxVC:
             load_file(ckpt_dir / "s3gen.safetensors"), strict=False
         )
         s3gen.to(device).eval()
+        s3gen.fuse_vocoder()
+        if dtype != torch.float32:
+            s3gen.set_dtype(dtype)
+        if quantize:
+            s3gen.quantize_dynamic()
 
         return cls(s3gen, device, ref_dict=ref_dict)
 
     @classmethod
-    def from_pretrained(cls, device) -> 'ChatterboxVC':
+    def from_pretrained(cls, device, quantize=False, dtype=torch.float32) -> 'ChatterboxVC':
         # Check if MPS is available on macOS
         if device == "mps" and not torch.backends.mps.is_available():
             if not torch.backends.mps.is_built():
@@ -71,7 +77,7 @@ class ChatterboxVC:
         for fpath in ["s3gen.safetensors", "conds.pt"]:
             local_path = hf_hub_download(repo_id=REPO_ID, filename=fpath)
 
-        return cls.from_local(Path(local_path).parent, device)
+        return cls.from_local(Path(local_path).parent, device, quantize=quantize, dtype=dtype)
 
     def set_target_voice(self, wav_fpath):
         ## Load reference wav
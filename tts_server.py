@@ -1,9 +1,11 @@
 import os
 import tempfile
 import json
+import struct
+import threading
 import torchaudio as ta
-from flask import Flask, request, send_file, render_template_string, jsonify
-from chatterbox.tts import ChatterboxTTS
+from flask import Flask, request, send_file, render_template_string, jsonify, Response, stream_with_context
+from chatterbox.tts import ChatterboxTTS, Conditionals
 from pathlib import Path
 from datetime import datetime
 import time
@@ -14,14 +16,26 @@ import torch
 from pydub import AudioSegment
 
 app = Flask(__name__)
-model = ChatterboxTTS.from_pretrained(device="cpu")
 
 # Create necessary directories
 VOICES_DIR = Path("voices")
 OUTPUT_DIR = Path("output")
+CONDS_CACHE_DIR = VOICES_DIR / "conds_cache"
 VOICES_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 
+# int8 dynamic quantization of T3 and S3Gen: faster on CPU, with a small drift of the output (see bench_quantize.py)
+QUANTIZE_MODEL = False
+
+# Reference processing for a voice is cached by content hash, so repeated voices skip it
+model = ChatterboxTTS.from_pretrained(device="cpu", conds_cache_dir=CONDS_CACHE_DIR, quantize=QUANTIZE_MODEL)
+model_lock = threading.Lock()
+
+# Number of script lines decoded together; bounds the memory of the batched KV cache.
+# Lines of concurrent requests share the same decode batch, a line takes over the slot of any finished one.
+MAX_BATCH_LINES = 4
+model.start_scheduler(max_batch_size=MAX_BATCH_LINES)
+
 # Store voice metadata
 VOICES_METADATA_FILE = VOICES_DIR / "voices.json"
 
@@ -35,6 +49,34 @@ def save_voices_metadata(metadata):
     with open(VOICES_METADATA_FILE, 'w') as f:
         json.dump(metadata, f, indent=2)
 
+# Loaded conditionals per voice name, so /generate doesn't hit the disk for every line
+voice_conds = {}
+
+def compute_voice_conds(voice_name, voice_path):
+    """Run the reference processing for a voice once and store the conditionals next to its wav."""
+    conds_path = VOICES_DIR / f"{voice_name}.conds.pt"
+    with model_lock:
+        conds = model.prepare_conditionals(voice_path)
+    conds.save(conds_path)
+    voice_conds[voice_name] = conds
+    return str(conds_path)
+
+def get_voice_conds(voice_name, metadata):
+    """Return the precomputed conditionals of a voice, backfilling voices uploaded before they were stored."""
+    if voice_name in voice_conds:
+        return voice_conds[voice_name]
+
+    voice_data = metadata[voice_name]
+    conds_path = voice_data.get("conds_path")
+    if conds_path is None or not Path(conds_path).exists():
+        voice_data["conds_path"] = compute_voice_conds(voice_name, voice_data["path"])
+        save_voices_metadata(metadata)
+        return voice_conds[voice_name]
+
+    conds = Conditionals.load(conds_path).to(model.device)
+    voice_conds[voice_name] = conds
+    return conds
+
 def merge_audio_clips(clips, sample_rate, silence_duration=0.3):
     """Merge multiple audio clips with natural pauses and fade effects."""
     try:
@@ -742,10 +784,18 @@ def upload_voice():
     voice_path = VOICES_DIR / f"{voice_name}.wav"
     audio_file.save(voice_path)
     
+    # Precompute the conditionals so /generate never touches the reference audio
+    try:
+        conds_path = compute_voice_conds(voice_name, voice_path)
+    except Exception as e:
+        voice_path.unlink()
+        return jsonify({"error": f"Failed to process voice audio: {str(e)}"}), 400
+    
     # Update metadata
     metadata = load_voices_metadata()
     metadata[voice_name] = {
         "path": str(voice_path),
+        "conds_path": conds_path,
         "created_at": str(datetime.now())
     }
     save_voices_metadata(metadata)
@@ -773,10 +823,14 @@ def delete_voice(voice_name):
     if voice_name not in metadata:
         return jsonify({"error": "Voice not found"}), 404
     
-    # Delete voice file
+    # Delete voice file and its precomputed conditionals
     voice_path = Path(metadata[voice_name]["path"])
     if voice_path.exists():
         voice_path.unlink()
+    conds_path = metadata[voice_name].get("conds_path")
+    if conds_path is not None and Path(conds_path).exists():
+        Path(conds_path).unlink()
+    voice_conds.pop(voice_name, None)
     
     # Update metadata
     del metadata[voice_name]
@@ -804,23 +858,23 @@ def generate():
         generated_clips = []
         audio_clips = []
         
-        # Generate audio for each script
-        for i, (voice_name, script) in enumerate(zip(voices, scripts)):
+        for voice_name in voices:
             if voice_name not in metadata:
                 return jsonify({"error": f"Voice not found: {voice_name}"}), 404
-            
-            voice_path = metadata[voice_name]["path"]
-            print(f"Generating audio {i+1}/{len(scripts)} for voice: {voice_name}")
-            print(f"Script: {script}")
-            
-            # Generate audio
-            wav = model.generate(
-                script,
-                audio_prompt_path=voice_path,
-                exaggeration=exaggeration,
-                temperature=temperature,
-                cfg_weight=cfg_weight
-            )
+        conds = [get_voice_conds(voice_name, metadata) for voice_name in voices]
+        
+        # Generate audio for the script, the lines are decoded together with those of other requests
+        print(f"Generating audio for {len(scripts)} lines with voices: {voices}")
+        wavs = model.generate_batch(
+            scripts,
+            conds=conds,
+            exaggeration=exaggeration,
+            temperature=temperature,
+            cfg_weight=cfg_weight
+        )
+        
+        for i, wav in enumerate(wavs):
+            voice_name, script = voices[i], scripts[i]
             
             # Save individual clip
             clip_filename = f"{voice_name}_{timestamp}_{i}.wav"
@@ -859,6 +913,70 @@ def generate():
             "status": "error"
         }), 500
 
+def wav_stream_header(sample_rate, num_channels=1, bits_per_sample=16):
+    """WAV header for a stream of unknown length, the RIFF and data sizes are set to the maximum."""
+    byte_rate = sample_rate * num_channels * bits_per_sample // 8
+    block_align = num_channels * bits_per_sample // 8
+    return (
+        b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, num_channels, sample_rate, byte_rate, block_align, bits_per_sample)
+        + b"data" + struct.pack("<I", 0xFFFFFFFF)
+    )
+
+def to_pcm16(wav):
+    """Convert a float waveform tensor in [-1, 1] to little-endian 16-bit PCM bytes."""
+    wav = wav.squeeze().clamp(-1.0, 1.0).numpy()
+    return (wav * 32767).astype("<i2").tobytes()
+
+@app.route('/generate_stream', methods=['POST'])
+def generate_stream():
+    """
+    Same form fields as /generate, plus an optional `format` ("wav" or "pcm"). The audio is sent as a chunked
+    response while it's being synthesized: 16-bit mono PCM at the model sample rate, behind a streaming WAV header
+    unless format is "pcm". Lines are separated by a short silence and nothing is saved to disk.
+    """
+    voices = request.form.getlist('voices[]')
+    scripts = request.form.getlist('scripts[]')
+    
+    if not voices or not scripts or len(voices) != len(scripts):
+        return jsonify({"error": "Invalid voice or script data"}), 400
+    
+    audio_format = request.form.get('format', 'wav')
+    if audio_format not in ('wav', 'pcm'):
+        return jsonify({"error": f"Unsupported format: {audio_format}"}), 400
+    
+    exaggeration = float(request.form.get('exaggeration', 0.5))
+    temperature = float(request.form.get('temperature', 0.8))
+    cfg_weight = float(request.form.get('cfg_weight', 0.5))
+    
+    # Validate everything before the response starts, errors can't be reported once audio is flowing
+    metadata = load_voices_metadata()
+    for voice_name in voices:
+        if voice_name not in metadata:
+            return jsonify({"error": f"Voice not found: {voice_name}"}), 404
+    conds = [get_voice_conds(voice_name, metadata) for voice_name in voices]
+    
+    silence = bytes(2 * int(0.3 * model.sr))
+    
+    def stream():
+        if audio_format == 'wav':
+            yield wav_stream_header(model.sr)
+        for i, (voice_name, script) in enumerate(zip(voices, scripts)):
+            print(f"Streaming audio {i+1}/{len(scripts)} for voice: {voice_name}")
+            if i > 0:
+                yield silence
+            for wav in model.generate_stream(
+                script,
+                conds=conds[i],
+                exaggeration=exaggeration,
+                temperature=temperature,
+                cfg_weight=cfg_weight
+            ):
+                yield to_pcm16(wav)
+    
+    mimetype = 'audio/wav' if audio_format == 'wav' else f'audio/L16;rate={model.sr};channels=1'
+    return Response(stream_with_context(stream()), mimetype=mimetype)
+
 @app.route('/audio/<filename>')
 def get_audio(filename):
     return send_file(OUTPUT_DIR / filename, mimetype='audio/wav')